@@ -1,20 +1,465 @@
 # api/app.py
-from fastapi import FastAPI, HTTPException, Path, Query
-from pydantic import BaseModel, Field
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, Path, Query, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from pymongo import AsyncMongoClient, ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ExecutionTimeout
+from pymongo import monitoring
 import os
+import io
+import sys
+import re
+import asyncio
+import csv
+import json
+import time
+import uuid
+import base64
+import bisect
+import logging
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from email.utils import format_datetime, parsedate_to_datetime
 from dotenv import load_dotenv
-from typing import List, Optional
-from datetime import datetime
-from bson import ObjectId
+from typing import List, Literal, Optional
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId, json_util
+from bson.binary import UuidRepresentation
+
+try:
+    import orjson
+except ImportError:  # opcional: sin orjson se usa el json de la stdlib
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:  # opcional: solo lo necesita /documents/search
+    np = None
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:  # opcional: sin brotli-asgi solo se comprime con gzip
+    BrotliMiddleware = None
+
+# Código compartido con la ingesta: una sola implementación en scripts/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from rollups import dia_de, increments as rollup_increments  # noqa: E402
+from search_fields import SEARCH_FIELDS, normaliza, search_terms  # noqa: E402
 
 load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
+# Cada worker de uvicorn/gunicorn (WEB_CONCURRENCY) abre su propio pool:
+# MONGO_POOL_BUDGET es el total de conexiones a repartir entre los workers
+# salvo que MONGO_MAX_POOL_SIZE fije el tamaño por worker.
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+MONGO_POOL_BUDGET = int(os.getenv("MONGO_POOL_BUDGET", "100"))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", str(max(10, MONGO_POOL_BUDGET // WEB_CONCURRENCY))))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_CONNECTING = int(os.getenv("MONGO_MAX_CONNECTING", "2"))
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", "5000"))
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", str(min(10, MONGO_MAX_POOL_SIZE))))
+PREWARM_LIMIT = int(os.getenv("PREWARM_LIMIT", "1000"))
+READY_TIMEOUT_MS = int(os.getenv("READY_TIMEOUT_MS", "1000"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "50000"))
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "10000"))
+STATS_TTL = float(os.getenv("STATS_TTL", "10"))
+ANALYTICS_TTL = float(os.getenv("ANALYTICS_TTL", "60"))
+ANALYTICS_CACHE_MAXSIZE = int(os.getenv("ANALYTICS_CACHE_MAXSIZE", "256"))
+ANALYTICS_MAX_TIME_MS = int(os.getenv("ANALYTICS_MAX_TIME_MS", "30000"))
+BATCH_GET_MAX = int(os.getenv("BATCH_GET_MAX", "1000"))
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "200"))
+# Validar las respuestas contra response_model es opcional: los documentos
+# vienen de Mongo y ya se validaron al escribirse.
+RESPONSE_VALIDATION = os.getenv("RESPONSE_VALIDATION", "false").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+VERSION_TTL = float(os.getenv("VERSION_TTL", "1"))
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                              "..", "scripts", "data", "vector_index"))
+VECTOR_NPROBE = int(os.getenv("VECTOR_NPROBE", "8"))
+# Formato de los _id nuevos: uuid (texto, 36 bytes), binary (UUID binario
+# BSON, 16 bytes) u objectid (12 bytes, ordenado por tiempo: inserciones al
+# final del índice _id en vez de en posiciones aleatorias).
+ID_MODE = os.getenv("ID_MODE", "uuid")
+PROPAGATION_WORKER = os.getenv("PROPAGATION_WORKER", "true").lower() in ("1", "true", "yes")
+PROPAGATION_BATCH_SIZE = int(os.getenv("PROPAGATION_BATCH_SIZE", "500"))
+PROPAGATION_PAUSE_MS = float(os.getenv("PROPAGATION_PAUSE_MS", "50"))
+PROPAGATION_POLL_S = float(os.getenv("PROPAGATION_POLL_S", "5"))
+PROPAGATION_LEASE_S = float(os.getenv("PROPAGATION_LEASE_S", "60"))
+if ID_MODE not in ("uuid", "binary", "objectid"):
+    raise ValueError(f"ID_MODE inválido: {ID_MODE}")
+
+slow_log = logging.getLogger("pharmacien.slow_queries")
+
+
+# Métricas en proceso (formato de texto de Prometheus en /metrics). Los
+# histogramas tienen cubetas fijas: registrar una observación es un bisect
+# y dos sumas, así que pueden quedarse activadas en producción.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DOCS_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = defaultdict(float)
+        self.gauges = defaultdict(float)
+        self.help = {}
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram(buckets)
+        hist.observe(value)
+
+    def inc(self, name, labels, value=1):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name, labels, value):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add(self, name, labels, value):
+        self.gauges[(name, tuple(sorted(labels.items())))] += value
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in pairs) + "}"
+
+        for (name, labels), hist in sorted(self.histograms.items()):
+            header(name, "histogram")
+            acc = 0
+            for le, n in zip(list(hist.buckets) + ["+Inf"], hist.counts):
+                acc += n
+                lines.append(f"{name}_bucket{fmt(labels, [('le', le)])} {acc}")
+            lines.append(f"{name}_sum{fmt(labels)} {hist.sum}")
+            lines.append(f"{name}_count{fmt(labels)} {hist.count}")
+        for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+            for (name, labels), value in sorted(values.items()):
+                header(name, kind)
+                lines.append(f"{name}{fmt(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.help.update({
+    "http_request_duration_seconds": "Latencia total de la petición por ruta",
+    "http_request_mongo_seconds": "Tiempo en comandos de Mongo por petición",
+    "http_request_render_seconds": "Tiempo de serialización de la respuesta por petición",
+    "mongo_command_duration_seconds": "Latencia de comandos de Mongo por colección",
+    "mongo_docs_returned": "Documentos devueltos por comando",
+    "mongo_pool_wait_seconds": "Espera para obtener una conexión del pool",
+    "mongo_pool_checked_out": "Conexiones del pool en uso",
+})
+
+# Tiempos de la petición en curso (Mongo y serialización); la middleware
+# crea el dict y los listeners/FastJSONResponse suman en él.
+request_timing = ContextVar("request_timing", default=None)
+
+def filter_shape(value):
+    # Estructura del filtro sin los valores: {"fecha": {"$gte": "?"}}
+    if isinstance(value, dict):
+        return {k: filter_shape(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [filter_shape(v) for v in value[:3]]
+    return "?"
+
+def command_filter(command):
+    if "filter" in command:
+        return command["filter"]
+    if "query" in command:
+        return command["query"]
+    if "pipeline" in command:
+        return [stage for stage in command["pipeline"] if "$match" in stage]
+    if "updates" in command:
+        return [u.get("q") for u in command["updates"][:3]]
+    return None
+
+class CommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self.pending = {}
+
+    def started(self, event):
+        command = event.command
+        collection = command.get("collection") if event.command_name == "getMore" else command.get(event.command_name)
+        self.pending[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else "-", command_filter(command))
+
+    def _finish(self, event, status):
+        collection, filtro = self.pending.pop((event.connection_id, event.request_id), ("-", None))
+        seconds = event.duration_micros / 1e6
+        labels = {"collection": collection, "command": event.command_name}
+        metrics.observe("mongo_command_duration_seconds", labels, seconds)
+        if status != "ok":
+            metrics.inc("mongo_command_errors_total", labels)
+        timing = request_timing.get()
+        if timing is not None:
+            timing["mongo"] += seconds
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            slow_log.warning("slow query %.1f ms %s.%s filter=%s", seconds * 1000, collection,
+                             event.command_name, json.dumps(filter_shape(filtro), default=str))
+        return labels
+
+    def succeeded(self, event):
+        labels = self._finish(event, "ok")
+        cursor = event.reply.get("cursor") if isinstance(event.reply, dict) else None
+        if cursor:
+            batch = cursor.get("firstBatch", cursor.get("nextBatch")) or []
+            metrics.observe("mongo_docs_returned", labels, len(batch), DOCS_BUCKETS)
+
+    def failed(self, event):
+        self._finish(event, "error")
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    def connection_checked_out(self, event):
+        metrics.observe("mongo_pool_wait_seconds", {}, event.duration)
+        metrics.add("mongo_pool_checked_out", {}, 1)
+
+    def connection_checked_in(self, event):
+        metrics.add("mongo_pool_checked_out", {}, -1)
+
+    def connection_check_out_failed(self, event):
+        metrics.inc("mongo_pool_checkout_failures_total", {"reason": event.reason})
+
+    # El resto de eventos del pool no se registran
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+# Cliente asíncrono: las rutas no bloquean un worker del threadpool
+# mientras esperan la respuesta de Mongo. Lo crea el lifespan de la app (un
+# cliente por worker, en su propio event loop) y lo cierra al apagarse.
+def make_client():
+    return AsyncMongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxConnecting=MONGO_MAX_CONNECTING,
+        serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+        connectTimeoutMS=MONGO_TIMEOUT_MS,
+        event_listeners=[CommandMetrics(), PoolMetrics()],
+        uuidRepresentation="standard",
+    )
+
+client = None
+db = None
+
+
+# Caché de lecturas por _id del catálogo (read-through). Por defecto vive en
+# el proceso (LRU con TTL); con CACHE_BACKEND=redis se comparte entre workers.
+class MemoryCache:
+    name = "memory"
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    async def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def set(self, key, value, ttl=None):
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self._data.pop(key, None)
+
+    async def size(self):
+        return len(self._data)
+
+    async def close(self):
+        pass
+
+class RedisCache:
+    name = "redis"
 
-app = FastAPI(title="Pharmacien API", version="2.0")
+    def __init__(self, url, ttl, prefix="pharmacien:"):
+        import redis.asyncio as redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._redis = redis.from_url(url)
+
+    async def get(self, key):
+        raw = await self._redis.get(self.prefix + key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json_util.loads(raw)
+
+    async def set(self, key, value, ttl=None):
+        await self._redis.set(self.prefix + key, json_util.dumps(value), ex=max(1, int(ttl or self.ttl)))
+
+    async def delete(self, *keys):
+        if keys:
+            await self._redis.delete(*(self.prefix + k for k in keys))
+
+    async def size(self):
+        return await self._redis.dbsize()
+
+    async def close(self):
+        await self._redis.aclose()
+
+CACHED_COLLECTIONS = {"proveedores", "medicamentos", "doctores", "farmacias"}
+
+def make_cache():
+    if CACHE_BACKEND == "redis":
+        return RedisCache(CACHE_URL, CACHE_TTL)
+    return MemoryCache(CACHE_MAXSIZE, CACHE_TTL)
+
+# Como el cliente de Mongo, las cachés las crea y las cierra el lifespan.
+# Los resultados de /analytics van aparte (siempre en el proceso): no
+# compiten por el LRU del catálogo ni cuentan en sus aciertos/fallos.
+cache = None
+analytics_cache = None
+
+# Serialización directa de documentos de Mongo a JSON (orjson si está
+# instalado), sin jsonable_encoder ni validación por elemento.
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def encode_json(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        t0 = time.perf_counter()
+        body = encode_json(content)
+        timing = request_timing.get()
+        if timing is not None:
+            timing["render"] += time.perf_counter() - t0
+        return body
+
+# Arranque en caliente: antes de aceptar peticiones cada worker abre
+# conexiones del pool y carga en caché el catálogo, sus versiones y el índice
+# vectorial. Si Mongo no responde, el worker arranca en frío y /ready lo
+# indica hasta que el ping vuelva a funcionar.
+startup = {"warm": False, "warmup_ms": None, "prewarmed": 0, "error": None}
+
+async def warm_up():
+    t0 = time.perf_counter()
+    try:
+        # Pings simultáneos: cada uno toma (o abre) una conexión del pool
+        await asyncio.gather(*(client.admin.command("ping") for _ in range(max(1, WARMUP_CONNECTIONS))))
+        for collection in sorted(CACHED_COLLECTIONS):
+            version, _ = await get_version(collection)
+            if PREWARM_LIMIT:
+                async for doc in db[collection].find().limit(PREWARM_LIMIT):
+                    doc = safe_doc(doc)
+                    await cache.set(f"{collection}:{version}:{doc['_id']}", doc)
+                    startup["prewarmed"] += 1
+        if np is not None:
+            await asyncio.to_thread(vector_index.load_if_changed)
+        startup["warm"] = True
+    except Exception as e:
+        startup["error"] = str(e)
+        logging.getLogger("pharmacien").warning("arranque en frío: %s", e)
+    startup["warmup_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+
+@asynccontextmanager
+async def lifespan(app):
+    global client, db, cache, analytics_cache
+    client = make_client()
+    db = client[DB_NAME]
+    cache = make_cache()
+    analytics_cache = MemoryCache(ANALYTICS_CACHE_MAXSIZE, ANALYTICS_TTL)
+    await warm_up()
+    worker = asyncio.create_task(propagation_worker()) if PROPAGATION_WORKER else None
+    try:
+        yield
+    finally:
+        if worker is not None:
+            worker.cancel()
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        await client.close()
+        await cache.close()
+
+app = FastAPI(title="Pharmacien API", version="2.0", default_response_class=FastJSONResponse,
+              lifespan=lifespan)
+
+# Compresión de las páginas grandes; brotli (que también negocia gzip)
+# si brotli-asgi está instalado.
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
 
 # Helper para convertir ObjectId a str
 def safe_doc(doc):
@@ -22,8 +467,385 @@ def safe_doc(doc):
         return None
     if "_id" in doc:
         doc["_id"] = str(doc["_id"])
+    # Campos internos que response_model filtraba
+    doc.pop("busqueda", None)
+    return doc
+
+
+# IDs: los clientes siempre ven y envían la forma de texto (safe_doc hace
+# str() de UUID/ObjectId). Los documentos creados antes de cambiar ID_MODE
+# conservan su _id de texto, así que las búsquedas aceptan las dos formas.
+def new_id():
+    if ID_MODE == "binary":
+        return uuid.uuid4()
+    if ID_MODE == "objectid":
+        return ObjectId()
+    return str(uuid.uuid4())
+
+def parse_id(id):
+    if ID_MODE == "binary":
+        try:
+            return uuid.UUID(id)
+        except (ValueError, TypeError, AttributeError):
+            return id
+    if ID_MODE == "objectid" and ObjectId.is_valid(id):
+        return ObjectId(id)
+    return id
+
+def id_values(ids):
+    values = []
+    for id in ids:
+        parsed = parse_id(id)
+        values.append(parsed)
+        if parsed is not id:
+            values.append(id)
+    return values
+
+def id_query(id):
+    parsed = parse_id(id)
+    return parsed if parsed is id else {"$in": [parsed, id]}
+
+def model_dict(model, **kwargs):
+    # by_alias: los campos `id` con alias se guardan como `_id`
+    kwargs.setdefault("by_alias", True)
+    return model.model_dump(**kwargs)
+
+def new_doc(payload):
+    data = model_dict(payload)
+    data["_id"] = new_id()
+    return data
+
+
+# La clave incluye la versión de la colección (ver get_version): cualquier
+# escritura que la suba, en este worker, en otro o en un swap de la ingesta,
+# deja sin uso las entradas anteriores, así el cuerpo nunca queda detrás del
+# ETag. Las entradas viejas salen por TTL/LRU.
+async def cache_prefix(collection):
+    version, _ = await get_version(collection.name)
+    return f"{collection.name}:{version}:"
+
+async def cached_find_one(collection, id):
+    key = await cache_prefix(collection) + str(id)
+    doc = await cache.get(key)
+    if doc is None:
+        doc = safe_doc(await collection.find_one({"_id": id_query(id)}))
+        if doc is not None:
+            await cache.set(key, doc)
     return doc
 
+async def cached_find_many(collection, ids):
+    # Lo que no está en caché se resuelve con una sola consulta $in
+    found = {}
+    prefix = await cache_prefix(collection)
+    for id in ids:
+        doc = await cache.get(prefix + str(id))
+        if doc is not None:
+            found[id] = doc
+    missing = [id for id in ids if id not in found]
+    if missing:
+        async for doc in collection.find({"_id": {"$in": id_values(missing)}}):
+            doc = safe_doc(doc)
+            found[doc["_id"]] = doc
+            await cache.set(prefix + doc["_id"], doc)
+    return found
+
+
+# Peticiones condicionales del catálogo: cada colección tiene un contador de
+# versión en _versiones que suben los create_* (y el swap de la ingesta, ver
+# scripts/staging.py). ETag y Last-Modified salen del contador, así un 304
+# no lee ningún documento. Cada worker guarda la versión VERSION_TTL segundos;
+# la misma versión forma parte de las claves de la caché (cache_prefix).
+VERSIONS_COLLECTION = "_versiones"
+_versions = {}
+
+async def get_version(collection):
+    entry = _versions.get(collection)
+    if entry and entry[0] > time.monotonic():
+        return entry[1], entry[2]
+    doc = await db[VERSIONS_COLLECTION].find_one({"_id": collection}) or {}
+    version, modificado = doc.get("version", 0), doc.get("modificado")
+    _versions[collection] = (time.monotonic() + VERSION_TTL, version, modificado)
+    return version, modificado
+
+async def bump_version(collection):
+    doc = await db[VERSIONS_COLLECTION].find_one_and_update(
+        {"_id": collection},
+        {"$inc": {"version": 1}, "$set": {"modificado": datetime.now(timezone.utc).replace(microsecond=0)}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    _versions[collection] = (time.monotonic() + VERSION_TTL, doc["version"], doc["modificado"])
+
+# Colección de la que depende cada expansión (su versión entra en el ETag)
+# (inventario sube su versión cuando cambia qué medicamentos tiene una
+# farmacia, no con cada cambio de stock)
+EXPANSION_SOURCES = {
+    "medicamentos": {"proveedores": ["proveedores"]},
+    "farmacias": {"medicamentos": ["inventario", "medicamentos"]},
+}
+
+async def not_modified(request, response, collection, expand=None, depends=()):
+    collections = [collection, *depends]
+    for f in (expand or "").split(","):
+        for source in EXPANSION_SOURCES.get(collection, {}).get(f.strip(), []):
+            if source not in collections:
+                collections.append(source)
+    versions = await asyncio.gather(*(get_version(c) for c in collections))
+    etag = 'W/"' + ".".join(f"{c}-{v}" for c, (v, _) in zip(collections, versions)) + '"'
+    fechas = [m.replace(tzinfo=m.tzinfo or timezone.utc) for _, m in versions if m]
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if fechas:
+        response.headers["Last-Modified"] = format_datetime(max(fechas).astimezone(timezone.utc), usegmt=True)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        fresh = "*" in tags or etag in tags or etag[2:] in tags
+    else:
+        fresh = False
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since and fechas:
+            try:
+                fresh = max(fechas) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                fresh = False
+    if fresh:
+        return Response(status_code=304, headers=dict(response.headers))
+    return None
+
+
+# Paginación por cursor (keyset): el token codifica la clave de orden del
+# último documento devuelto, así la página N cuesta lo mismo que la primera.
+CURSOR_JSON_OPTIONS = json_util.JSONOptions(uuid_representation=UuidRepresentation.STANDARD)
+
+def encode_cursor(doc, sort_field=None):
+    key = {"_id": doc["_id"]}
+    if sort_field:
+        key[sort_field] = doc.get(sort_field)
+    raw = json_util.dumps(key, json_options=CURSOR_JSON_OPTIONS).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(token, sort_field=None):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        key = json_util.loads(raw, json_options=CURSOR_JSON_OPTIONS)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if not isinstance(key, dict) or "_id" not in key or (sort_field and sort_field not in key):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return key
+
+# Orden BSON de los tipos de _id posibles: $gt solo compara dentro del mismo
+# tipo, así que si la colección mezcla IDs de texto y compactos (ID_MODE
+# cambiado) "después de" también incluye los tipos posteriores.
+ID_TYPES = ["string", "binData", "objectId"]
+
+def id_after(value):
+    after = {"_id": {"$gt": value}}
+    if ID_MODE == "uuid":
+        return after
+    pos = 0 if isinstance(value, str) else 1 if isinstance(value, (uuid.UUID, bytes)) else 2
+    if pos + 1 < len(ID_TYPES):
+        return {"$or": [after, {"_id": {"$type": ID_TYPES[pos + 1:]}}]}
+    return after
+
+def keyset_filter(key, sort_field=None):
+    after = id_after(key["_id"])
+    if not sort_field:
+        return after
+    return {"$or": [
+        {sort_field: {"$gt": key[sort_field]}},
+        {"$and": [{sort_field: key[sort_field]}, after]},
+    ]}
+
+async def paginate(collection, response, limit, skip=0, cursor=None, sort_field=None, query=None,
+                   projection=None):
+    query = dict(query or {})
+    if cursor:
+        after = keyset_filter(decode_cursor(cursor, sort_field), sort_field)
+        query = {"$and": [query, after]} if query else after
+    sort = [("_id", ASCENDING)]
+    if sort_field:
+        sort.insert(0, (sort_field, ASCENDING))
+    find = collection.find(query, projection).sort(sort)
+    if skip and not cursor:
+        find = find.skip(skip)
+    # Se pide un documento extra para saber si hay página siguiente
+    docs = await find.limit(limit + 1).to_list(None)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(docs[-1], sort_field)
+    return [safe_doc(d) for d in docs]
+
+# Filtros de los listados: cada uno tiene un índice en INDEX_SPECS
+# (scripts/create_indexes_and_validators.py) que termina en la clave de orden.
+def date_range(desde, hasta):
+    rango = {}
+    if desde:
+        rango["$gte"] = desde
+    if hasta:
+        rango["$lt"] = hasta
+    return rango
+
+def parse_fields(fields, model, sort_field=None):
+    if not fields:
+        return None
+    names = [f.strip() for f in fields.split(",") if f.strip()]
+    allowed = set(model_fields(model)) | {"_id"}
+    unknown = [n for n in names if n.split(".")[0] not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Campos desconocidos: {', '.join(unknown)}")
+    projection = dict.fromkeys(names, 1)
+    if sort_field:
+        projection[sort_field] = 1
+    return projection
+
+def ids_filter(query, ids):
+    if ids:
+        query["_id"] = {"$in": id_values([i for i in ids.split(",") if i])}
+    return query
+
+# Por defecto las respuestas se codifican directamente; con
+# RESPONSE_VALIDATION se devuelven a FastAPI para validar con response_model,
+# salvo las que ya no cumplen el modelo (proyección o expansión: raw=True).
+def respond(content, response=None, raw=False, status_code=200):
+    if RESPONSE_VALIDATION and not raw:
+        return content
+    return FastJSONResponse(content, status_code=status_code,
+                            headers=dict(response.headers) if response is not None else None)
+
+
+# Expansión de referencias (expand=campo): los IDs o nombres referenciados
+# por todos los documentos se resuelven con una segunda consulta $in en
+# lugar de una petición por referencia.
+async def find_by(collection, field, values):
+    values = list(values)
+    if not values:
+        return {}
+    if field == "_id" and collection.name in CACHED_COLLECTIONS:
+        return await cached_find_many(collection, values)
+    if field == "_id":
+        values = id_values(values)
+    found = {}
+    async for doc in collection.find({field: {"$in": values}}):
+        doc = safe_doc(doc)
+        found.setdefault(doc[field], doc)
+    return found
+
+async def expand_medicamento_proveedores(docs):
+    found = await find_by(db.proveedores, "_id", {p for d in docs for p in d.get("proveedores") or []})
+    for d in docs:
+        d["proveedores"] = [found.get(p, {"_id": p}) for p in d.get("proveedores") or []]
+
+async def expand_farmacia_medicamentos(docs):
+    # Desde inventario (índice farmacia_id, _id) y el catálogo (caché)
+    rows = defaultdict(list)
+    async for r in db.inventario.find({"farmacia_id": {"$in": [str(d["_id"]) for d in docs]}},
+                                      {"farmacia_id": 1, "medicamento_id": 1, "medicamento_nombre": 1},
+                                      sort=[("farmacia_id", ASCENDING), ("_id", ASCENDING)]):
+        rows[r["farmacia_id"]].append(r)
+    found = await find_by(db.medicamentos, "_id", {r["medicamento_id"] for rs in rows.values() for r in rs})
+    for d in docs:
+        d["medicamentos"] = [
+            found.get(r["medicamento_id"]) or {"_id": r["medicamento_id"], "nombre": r.get("medicamento_nombre")}
+            for r in rows[str(d["_id"])]
+        ]
+
+async def farmacias_con(nombre):
+    # IDs de las farmacias con el medicamento en inventario (índice medicamento_id, stock)
+    medicamento = (await find_by(db.medicamentos, "nombre", [nombre])).get(nombre)
+    if medicamento is None:
+        return []
+    return await db.inventario.distinct("farmacia_id", {"medicamento_id": str(medicamento["_id"])})
+
+async def expand_cita_receta(docs):
+    found = await find_by(db.medicamentos, "_id", {r["medicamento_id"] for d in docs for r in d.get("receta") or []})
+    for d in docs:
+        d["receta"] = [dict(r, medicamento=found.get(r["medicamento_id"])) for r in d.get("receta") or []]
+
+async def expand_transaccion_cita(docs):
+    found = await find_by(db.citas, "_id", {d["citaref"] for d in docs if d.get("citaref")})
+    for d in docs:
+        if d.get("citaref"):
+            d["cita"] = found.get(d["citaref"])
+
+EXPANSIONS = {
+    "medicamentos": {"proveedores": expand_medicamento_proveedores},
+    "farmacias": {"medicamentos": expand_farmacia_medicamentos},
+    "citas": {"receta": expand_cita_receta},
+    "transacciones": {"citaref": expand_transaccion_cita},
+}
+
+async def expand_docs(collection, docs, expand):
+    if not expand:
+        return docs
+    available = EXPANSIONS.get(collection, {})
+    fields = [f.strip() for f in expand.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"No se puede expandir: {', '.join(unknown)}")
+    # Copias: los documentos pueden venir de la caché compartida
+    docs = [dict(d) for d in docs]
+    await asyncio.gather(*(available[f](docs) for f in fields))
+    return docs
+
+
+# Inserción masiva: acepta un arreglo JSON o NDJSON, valida todo en una
+# pasada y escribe en lotes desordenados; los errores se reportan por
+# posición del documento en el cuerpo recibido.
+async def read_bulk_body(request):
+    body = await request.body()
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cuerpo JSON/NDJSON inválido")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Se esperaba un arreglo de documentos")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Máximo {BULK_MAX_ITEMS} documentos por petición")
+    return items
+
+async def bulk_insert(collection, model, items):
+    errors = []
+    valid = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({"index": i, "error": "Se esperaba un objeto"})
+            continue
+        try:
+            data = new_doc(model(**item))
+        except ValidationError as e:
+            errors.append({"index": i, "error": [{"loc": list(err["loc"]), "msg": err["msg"]} for err in e.errors()]})
+            continue
+        valid.append((i, data))
+
+    inserted = []
+    for start in range(0, len(valid), BULK_BATCH_SIZE):
+        batch = valid[start:start + BULK_BATCH_SIZE]
+        try:
+            await collection.insert_many([data for _, data in batch], ordered=False)
+            inserted.extend(data for _, data in batch)
+        except BulkWriteError as e:
+            failed = set()
+            for err in e.details.get("writeErrors", []):
+                failed.add(err["index"])
+                errors.append({"index": batch[err["index"]][0], "error": err.get("errmsg")})
+            inserted.extend(data for j, (_, data) in enumerate(batch) if j not in failed)
+    errors.sort(key=lambda e: e["index"])
+    return inserted, errors
+
+
+# Rollups materializados (ver scripts/rollups.py, que los regenera con
+# $merge): cada inserción suma sus totales del día con upserts $inc.
+async def update_rollups(collection, docs):
+    for rollup, ops in rollup_increments(collection, docs).items():
+        await db[rollup].bulk_write(ops, ordered=False)
+
+
+# `_id` se declara como `id` con alias: pydantic trata los nombres con guion
+# bajo como atributos privados y los descartaría al validar y al serializar.
 
 # Proveedores
 class ProveedorIn(BaseModel):
@@ -33,7 +855,7 @@ class ProveedorIn(BaseModel):
     ciudad: str
 
 class ProveedorOut(ProveedorIn):
-    _id: str
+    id: str = Field(..., alias="_id")
 
 # Medicamentos
 class CategoriaEmbed(BaseModel):
@@ -47,7 +869,7 @@ class MedicamentoIn(BaseModel):
     proveedores: List[str] = []
 
 class MedicamentoOut(MedicamentoIn):
-    _id: str
+    id: str = Field(..., alias="_id")
 
 # Clientes
 class ClienteIn(BaseModel):
@@ -56,7 +878,7 @@ class ClienteIn(BaseModel):
     telefono: str
 
 class ClienteOut(ClienteIn):
-    _id: str
+    id: str = Field(..., alias="_id")
 
 # Doctores
 class DoctorIn(BaseModel):
@@ -66,11 +888,12 @@ class DoctorIn(BaseModel):
     telefono: str
 
 class DoctorOut(DoctorIn):
-    _id: str
+    id: str = Field(..., alias="_id")
 
 # Farmacias
 class EmpleadoEmbed(BaseModel):
-    _id: str
+    model_config = ConfigDict(populate_by_name=True)
+    id: str = Field(..., alias="_id")
     nombre: str
     puesto: str
     telefono: str
@@ -80,19 +903,59 @@ class FarmaciaIn(BaseModel):
     direccion: str
     telefono: str
     empleados: List[EmpleadoEmbed] = []
+    # Nombres del catálogo: al crear se guardan como entradas de inventario
     medicamentos: List[str] = []
 
 class FarmaciaOut(FarmaciaIn):
-    _id: str
+    id: str = Field(..., alias="_id")
+
+# Inventario: un documento por (farmacia, medicamento) con su stock, en vez
+# de la lista de nombres embebida en cada farmacia
+class InventarioIn(BaseModel):
+    stock: int = Field(..., ge=0)
+
+class InventarioOut(InventarioIn):
+    id: str = Field(..., alias="_id")
+    farmacia_id: str
+    medicamento_id: str
+    medicamento_nombre: Optional[str] = None
+
+class DecrementoIn(BaseModel):
+    cantidad: int = Field(1, ge=1)
+
+# Actualizaciones parciales (PATCH): solo se aplican los campos enviados
+class ClientePatch(BaseModel):
+    nombre: Optional[str] = None
+    direccion: Optional[str] = None
+    telefono: Optional[str] = None
+
+class DoctorPatch(BaseModel):
+    nombre: Optional[str] = None
+    apellido: Optional[str] = None
+    especialidad: Optional[str] = None
+    telefono: Optional[str] = None
+
+class MedicamentoPatch(BaseModel):
+    nombre: Optional[str] = None
+    precio: Optional[float] = None
+    categoria: Optional[CategoriaEmbed] = None
+    proveedores: Optional[List[str]] = None
+
+class EmpleadoPatch(BaseModel):
+    nombre: Optional[str] = None
+    puesto: Optional[str] = None
+    telefono: Optional[str] = None
 
 # Citas
 class ClienteRef(BaseModel):
-    _id: str
+    model_config = ConfigDict(populate_by_name=True)
+    id: str = Field(..., alias="_id")
     nombre: str
     telefono: str
 
 class DoctorRef(BaseModel):
-    _id: str
+    model_config = ConfigDict(populate_by_name=True)
+    id: str = Field(..., alias="_id")
     nombre: str
     especialidad: str
 
@@ -109,7 +972,7 @@ class CitaIn(BaseModel):
     receta: List[RecetaEmbed] = []
 
 class CitaOut(CitaIn):
-    _id: str
+    id: str = Field(..., alias="_id")
 
 # Transacciones
 class TransaccionIn(BaseModel):
@@ -120,165 +983,1072 @@ class TransaccionIn(BaseModel):
     citaref: Optional[str] = None
 
 class TransaccionOut(TransaccionIn):
-    _id: str
+    id: str = Field(..., alias="_id")
+
+# Modelo de entrada de cada colección servida por la API
+COLLECTION_MODELS = {
+    "proveedores": ProveedorIn,
+    "medicamentos": MedicamentoIn,
+    "clientes": ClienteIn,
+    "doctores": DoctorIn,
+    "farmacias": FarmaciaIn,
+    "citas": CitaIn,
+    "transacciones": TransaccionIn,
+}
+
+def model_fields(model):
+    return list(model.model_fields)
 
 
 # ============ PROVEEDORES ============
 @app.get("/proveedores", response_model=List[ProveedorOut])
-def get_proveedores(limit: int = Query(50, le=100), skip: int = 0):
-    cursor = db.proveedores.find().skip(skip).limit(limit)
-    return [safe_doc(d) for d in cursor]
+async def get_proveedores(request: Request, response: Response, limit: int = Query(50, ge=1, le=100),
+                          skip: int = Query(0, ge=0), cursor: Optional[str] = None, ids: Optional[str] = None):
+    cached = await not_modified(request, response, "proveedores")
+    if cached:
+        return cached
+    query = ids_filter({}, ids)
+    return respond(await paginate(db.proveedores, response, limit, skip, cursor, query=query), response)
 
 @app.get("/proveedores/{id}", response_model=ProveedorOut)
-def get_proveedor(id: str):
-    doc = db.proveedores.find_one({"_id": id})
+async def get_proveedor(id: str, request: Request, response: Response):
+    cached = await not_modified(request, response, "proveedores")
+    if cached:
+        return cached
+    doc = await cached_find_one(db.proveedores, id)
     if not doc:
         raise HTTPException(status_code=404, detail="Proveedor no encontrado")
-    return safe_doc(doc)
+    return respond(safe_doc(doc), response)
 
 @app.post("/proveedores", response_model=ProveedorOut, status_code=201)
-def create_proveedor(payload: ProveedorIn):
-    import uuid
-    data = payload.dict()
-    data["_id"] = str(uuid.uuid4())
-    db.proveedores.insert_one(data)
-    return data
+async def create_proveedor(payload: ProveedorIn):
+    data = new_doc(payload)
+    await db.proveedores.insert_one(data)
+    bump_stats("proveedores")
+    await bump_version("proveedores")
+    return respond(safe_doc(data), status_code=201)
 
 # ============ MEDICAMENTOS ============
 @app.get("/medicamentos", response_model=List[MedicamentoOut])
-def get_medicamentos(limit: int = Query(50, le=100), skip: int = 0):
-    cursor = db.medicamentos.find().skip(skip).limit(limit)
-    return [safe_doc(d) for d in cursor]
+async def get_medicamentos(request: Request, response: Response, limit: int = Query(50, ge=1, le=100),
+                           skip: int = Query(0, ge=0), cursor: Optional[str] = None, categoria: Optional[str] = None,
+                           proveedor: Optional[str] = None, fields: Optional[str] = None,
+                           ids: Optional[str] = None, expand: Optional[str] = None):
+    cached = await not_modified(request, response, "medicamentos", expand)
+    if cached:
+        return cached
+    query = ids_filter({}, ids)
+    if categoria:
+        query["categoria.nombre"] = categoria
+    if proveedor:
+        query["proveedores"] = proveedor
+    projection = parse_fields(fields, MedicamentoIn)
+    docs = await paginate(db.medicamentos, response, limit, skip, cursor, query=query, projection=projection)
+    docs = await expand_docs("medicamentos", docs, expand)
+    return respond(docs, response, raw=projection or expand)
 
 @app.get("/medicamentos/{id}", response_model=MedicamentoOut)
-def get_medicamento(id: str):
-    doc = db.medicamentos.find_one({"_id": id})
+async def get_medicamento(id: str, request: Request, response: Response, expand: Optional[str] = None):
+    cached = await not_modified(request, response, "medicamentos", expand)
+    if cached:
+        return cached
+    doc = await cached_find_one(db.medicamentos, id)
     if not doc:
         raise HTTPException(status_code=404, detail="Medicamento no encontrado")
-    return safe_doc(doc)
+    if expand:
+        docs = await expand_docs("medicamentos", [safe_doc(doc)], expand)
+        return respond(docs[0], response, raw=True)
+    return respond(safe_doc(doc), response)
 
 @app.post("/medicamentos", response_model=MedicamentoOut, status_code=201)
-def create_medicamento(payload: MedicamentoIn):
-    import uuid
-    data = payload.dict()
-    data["_id"] = str(uuid.uuid4())
-    db.medicamentos.insert_one(data)
-    return data
+async def create_medicamento(payload: MedicamentoIn):
+    data = new_doc(payload)
+    data["busqueda"] = search_terms("medicamentos", data)
+    await db.medicamentos.insert_one(data)
+    bump_stats("medicamentos")
+    await bump_version("medicamentos")
+    return respond(safe_doc(data), status_code=201)
 
 # ============ CLIENTES ============
 @app.get("/clientes", response_model=List[ClienteOut])
-def get_clientes(limit: int = Query(50, le=100), skip: int = 0):
-    cursor = db.clientes.find().skip(skip).limit(limit)
-    return [safe_doc(d) for d in cursor]
+async def get_clientes(response: Response, limit: int = Query(50, ge=1, le=100), skip: int = Query(0, ge=0),
+                       cursor: Optional[str] = None, ids: Optional[str] = None):
+    query = ids_filter({}, ids)
+    return respond(await paginate(db.clientes, response, limit, skip, cursor, query=query), response)
 
 @app.get("/clientes/{id}", response_model=ClienteOut)
-def get_cliente(id: str):
-    doc = db.clientes.find_one({"_id": id})
+async def get_cliente(id: str):
+    doc = await db.clientes.find_one({"_id": id_query(id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Cliente no encontrado")
-    return safe_doc(doc)
+    return respond(safe_doc(doc))
 
 @app.post("/clientes", response_model=ClienteOut, status_code=201)
-def create_cliente(payload: ClienteIn):
-    import uuid
-    data = payload.dict()
-    data["_id"] = str(uuid.uuid4())
-    db.clientes.insert_one(data)
-    return data
+async def create_cliente(payload: ClienteIn):
+    data = new_doc(payload)
+    data["busqueda"] = search_terms("clientes", data)
+    await db.clientes.insert_one(data)
+    bump_stats("clientes")
+    return respond(safe_doc(data), status_code=201)
 
 # ============ DOCTORES ============
 @app.get("/doctores", response_model=List[DoctorOut])
-def get_doctores(limit: int = Query(50, le=100), skip: int = 0):
-    cursor = db.doctores.find().skip(skip).limit(limit)
-    return [safe_doc(d) for d in cursor]
+async def get_doctores(response: Response, limit: int = Query(50, ge=1, le=100), skip: int = Query(0, ge=0),
+                       cursor: Optional[str] = None, ids: Optional[str] = None):
+    query = ids_filter({}, ids)
+    return respond(await paginate(db.doctores, response, limit, skip, cursor, query=query), response)
 
 @app.get("/doctores/{id}", response_model=DoctorOut)
-def get_doctor(id: str):
-    doc = db.doctores.find_one({"_id": id})
+async def get_doctor(id: str):
+    doc = await cached_find_one(db.doctores, id)
     if not doc:
         raise HTTPException(status_code=404, detail="Doctor no encontrado")
-    return safe_doc(doc)
+    return respond(safe_doc(doc))
 
 @app.post("/doctores", response_model=DoctorOut, status_code=201)
-def create_doctor(payload: DoctorIn):
-    import uuid
-    data = payload.dict()
-    data["_id"] = str(uuid.uuid4())
-    db.doctores.insert_one(data)
-    return data
+async def create_doctor(payload: DoctorIn):
+    data = new_doc(payload)
+    data["busqueda"] = search_terms("doctores", data)
+    await db.doctores.insert_one(data)
+    bump_stats("doctores")
+    return respond(safe_doc(data), status_code=201)
 
 # ============ FARMACIAS ============
 @app.get("/farmacias", response_model=List[FarmaciaOut])
-def get_farmacias(limit: int = Query(50, le=100), skip: int = 0):
-    cursor = db.farmacias.find().skip(skip).limit(limit)
-    return [safe_doc(d) for d in cursor]
+async def get_farmacias(request: Request, response: Response, limit: int = Query(50, ge=1, le=100),
+                        skip: int = Query(0, ge=0), cursor: Optional[str] = None, ciudad: Optional[str] = None,
+                        medicamento: Optional[str] = None, fields: Optional[str] = None,
+                        ids: Optional[str] = None, expand: Optional[str] = None):
+    cached = await not_modified(request, response, "farmacias", expand,
+                                depends=["inventario", "medicamentos"] if medicamento else ())
+    if cached:
+        return cached
+    query = ids_filter({}, ids)
+    if ciudad:
+        query["ciudad"] = ciudad
+    if medicamento:
+        query["$and"] = [{"_id": {"$in": id_values(await farmacias_con(medicamento))}}]
+    projection = parse_fields(fields, FarmaciaIn)
+    # La lista embebida (datos sin migrar) no se envía salvo con fields=;
+    # expand=medicamentos la reemplaza por la de inventario
+    if projection is None:
+        projection = {"medicamentos": 0}
+    docs = await paginate(db.farmacias, response, limit, skip, cursor, query=query, projection=projection)
+    docs = await expand_docs("farmacias", docs, expand)
+    return respond(docs, response, raw=fields or expand)
 
 @app.get("/farmacias/{id}", response_model=FarmaciaOut)
-def get_farmacia(id: str):
-    doc = db.farmacias.find_one({"_id": id})
+async def get_farmacia(id: str, request: Request, response: Response, expand: Optional[str] = None):
+    cached = await not_modified(request, response, "farmacias", expand)
+    if cached:
+        return cached
+    doc = await cached_find_one(db.farmacias, id)
     if not doc:
         raise HTTPException(status_code=404, detail="Farmacia no encontrada")
-    return safe_doc(doc)
+    if expand:
+        docs = await expand_docs("farmacias", [safe_doc(doc)], expand)
+        return respond(docs[0], response, raw=True)
+    # Igual que en el listado: la lista embebida solo sale con expand=
+    doc = {k: v for k, v in doc.items() if k != "medicamentos"}
+    return respond(safe_doc(doc), response)
 
 @app.post("/farmacias", response_model=FarmaciaOut, status_code=201)
-def create_farmacia(payload: FarmaciaIn):
-    import uuid
-    data = payload.dict()
-    data["_id"] = str(uuid.uuid4())
-    db.farmacias.insert_one(data)
-    return data
+async def create_farmacia(payload: FarmaciaIn):
+    # Los medicamentos se guardan como entradas de inventario (stock 0, igual
+    # que scripts/migrate_inventario.py), no como lista embebida.
+    data = new_doc(payload)
+    nombres = sorted(set(data.pop("medicamentos", None) or []))
+    catalogo = await find_by(db.medicamentos, "nombre", nombres)
+    faltan = [n for n in nombres if n not in catalogo]
+    if faltan:
+        raise HTTPException(status_code=400, detail=f"Medicamentos fuera del catálogo: {', '.join(faltan)}")
+    await db.farmacias.insert_one(data)
+    if nombres:
+        await db.inventario.insert_many([
+            {"_id": new_id(), "farmacia_id": str(data["_id"]), "medicamento_id": str(catalogo[n]["_id"]),
+             "medicamento_nombre": n, "stock": 0}
+            for n in nombres
+        ], ordered=False)
+        await bump_version("inventario")
+    bump_stats("farmacias")
+    await bump_version("farmacias")
+    return respond(safe_doc(data), status_code=201)
+
+# ============ INVENTARIO ============
+# Índices en INDEX_SPECS: único (farmacia_id, medicamento_id) para las
+# actualizaciones de stock y (farmacia_id, _id) para paginar por farmacia.
+@app.get("/farmacias/{id}/inventario", response_model=List[InventarioOut])
+async def get_inventario(id: str, response: Response, limit: int = Query(50, ge=1, le=100), skip: int = Query(0, ge=0),
+                         cursor: Optional[str] = None, en_stock: bool = False):
+    query = {"farmacia_id": id}
+    if en_stock:
+        query["stock"] = {"$gt": 0}
+    return respond(await paginate(db.inventario, response, limit, skip, cursor, query=query), response)
+
+@app.put("/farmacias/{id}/inventario/{medicamento_id}", response_model=InventarioOut)
+async def set_stock(id: str, medicamento_id: str, payload: InventarioIn):
+    farmacia, medicamento = await asyncio.gather(cached_find_one(db.farmacias, id),
+                                                 cached_find_one(db.medicamentos, medicamento_id))
+    if not farmacia:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    if not medicamento:
+        raise HTTPException(status_code=404, detail="Medicamento no encontrado")
+    nuevo_id = new_id()
+    args = ({"farmacia_id": id, "medicamento_id": medicamento_id},
+            {"$set": {"stock": payload.stock, "medicamento_nombre": medicamento["nombre"],
+                      "actualizado": datetime.now(timezone.utc)},
+             "$setOnInsert": {"_id": nuevo_id}})
+    try:
+        doc = await db.inventario.find_one_and_update(*args, upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # Dos PUT concurrentes sobre un par nuevo: el otro ya insertó la
+        # entrada (índice único), el reintento la actualiza.
+        doc = await db.inventario.find_one_and_update(*args, upsert=True, return_document=ReturnDocument.AFTER)
+    if doc["_id"] == nuevo_id:
+        # Entrada nueva: cambia la lista de medicamentos de la farmacia
+        await bump_version("inventario")
+    return respond(safe_doc(doc))
+
+# Decremento atómico: la condición stock >= cantidad va en el filtro, así
+# dos ventas concurrentes nunca dejan el stock en negativo.
+@app.post("/farmacias/{id}/inventario/{medicamento_id}/decrementar", response_model=InventarioOut)
+async def decrement_stock(id: str, medicamento_id: str, payload: DecrementoIn):
+    doc = await db.inventario.find_one_and_update(
+        {"farmacia_id": id, "medicamento_id": medicamento_id, "stock": {"$gte": payload.cantidad}},
+        {"$inc": {"stock": -payload.cantidad}, "$set": {"actualizado": datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER)
+    if doc is None:
+        actual = await db.inventario.find_one({"farmacia_id": id, "medicamento_id": medicamento_id}, {"stock": 1})
+        if actual is None:
+            raise HTTPException(status_code=404, detail="Medicamento sin inventario en esta farmacia")
+        raise HTTPException(status_code=409, detail=f"Stock insuficiente (disponible: {actual['stock']})")
+    return respond(safe_doc(doc))
 
 # ============ CITAS ============
 @app.get("/citas", response_model=List[CitaOut])
-def get_citas(limit: int = Query(50, le=100), skip: int = 0):
-    cursor = db.citas.find().skip(skip).limit(limit)
-    return [safe_doc(d) for d in cursor]
+async def get_citas(response: Response, limit: int = Query(50, ge=1, le=100), skip: int = Query(0, ge=0),
+                    cursor: Optional[str] = None, desde: Optional[datetime] = None,
+                    hasta: Optional[datetime] = None, doctor_id: Optional[str] = None,
+                    cliente_id: Optional[str] = None, fields: Optional[str] = None,
+                    ids: Optional[str] = None, expand: Optional[str] = None):
+    query = ids_filter({}, ids)
+    if desde or hasta:
+        query["fecha"] = date_range(desde, hasta)
+    if doctor_id:
+        query["doctor._id"] = doctor_id
+    if cliente_id:
+        query["cliente._id"] = cliente_id
+    projection = parse_fields(fields, CitaIn, sort_field="fecha")
+    docs = await paginate(db.citas, response, limit, skip, cursor, sort_field="fecha",
+                          query=query, projection=projection)
+    docs = await expand_docs("citas", docs, expand)
+    return respond(docs, response, raw=projection or expand)
 
 @app.get("/citas/{id}", response_model=CitaOut)
-def get_cita(id: str):
-    doc = db.citas.find_one({"_id": id})
+async def get_cita(id: str, expand: Optional[str] = None):
+    doc = await db.citas.find_one({"_id": id_query(id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Cita no encontrada")
-    return safe_doc(doc)
+    if expand:
+        docs = await expand_docs("citas", [safe_doc(doc)], expand)
+        return respond(docs[0], raw=True)
+    return respond(safe_doc(doc))
 
 @app.post("/citas", response_model=CitaOut, status_code=201)
-def create_cita(payload: CitaIn):
-    import uuid
-    data = payload.dict()
-    data["_id"] = str(uuid.uuid4())
-    db.citas.insert_one(data)
-    return data
+async def create_cita(payload: CitaIn):
+    data = new_doc(payload)
+    await db.citas.insert_one(data)
+    await update_rollups("citas", [data])
+    bump_stats("citas")
+    return respond(safe_doc(data), status_code=201)
+
+@app.post("/citas/bulk")
+async def create_citas_bulk(request: Request, response: Response):
+    items = await read_bulk_body(request)
+    inserted, errors = await bulk_insert(db.citas, CitaIn, items)
+    bump_stats("citas", len(inserted))
+    await update_rollups("citas", inserted)
+    response.status_code = 207 if errors else 201
+    return {"received": len(items), "inserted": len(inserted), "errors": errors}
 
 # ============ TRANSACCIONES ============
 @app.get("/transacciones", response_model=List[TransaccionOut])
-def get_transacciones(limit: int = Query(50, le=100), skip: int = 0):
-    cursor = db.transacciones.find().skip(skip).limit(limit)
-    return [safe_doc(d) for d in cursor]
+async def get_transacciones(response: Response, limit: int = Query(50, ge=1, le=100), skip: int = Query(0, ge=0),
+                            cursor: Optional[str] = None, desde: Optional[datetime] = None,
+                            hasta: Optional[datetime] = None, metodopago: Optional[str] = None,
+                            empleado_id: Optional[str] = None, citaref: Optional[str] = None,
+                            fields: Optional[str] = None, ids: Optional[str] = None,
+                            expand: Optional[str] = None):
+    query = ids_filter({}, ids)
+    if desde or hasta:
+        query["fecha"] = date_range(desde, hasta)
+    if metodopago:
+        query["metodopago"] = metodopago
+    if empleado_id:
+        query["empleado._id"] = empleado_id
+    if citaref:
+        query["citaref"] = citaref
+    projection = parse_fields(fields, TransaccionIn, sort_field="fecha")
+    docs = await paginate(db.transacciones, response, limit, skip, cursor, sort_field="fecha",
+                          query=query, projection=projection)
+    docs = await expand_docs("transacciones", docs, expand)
+    return respond(docs, response, raw=projection or expand)
 
 @app.get("/transacciones/{id}", response_model=TransaccionOut)
-def get_transaccion(id: str):
-    doc = db.transacciones.find_one({"_id": id})
+async def get_transaccion(id: str, expand: Optional[str] = None):
+    doc = await db.transacciones.find_one({"_id": id_query(id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Transacción no encontrada")
-    return safe_doc(doc)
+    if expand:
+        docs = await expand_docs("transacciones", [safe_doc(doc)], expand)
+        return respond(docs[0], raw=True)
+    return respond(safe_doc(doc))
 
 @app.post("/transacciones", response_model=TransaccionOut, status_code=201)
-def create_transaccion(payload: TransaccionIn):
-    import uuid
-    data = payload.dict()
-    data["_id"] = str(uuid.uuid4())
-    db.transacciones.insert_one(data)
-    return data
+async def create_transaccion(payload: TransaccionIn):
+    data = new_doc(payload)
+    await db.transacciones.insert_one(data)
+    await update_rollups("transacciones", [data])
+    bump_stats("transacciones")
+    return respond(safe_doc(data), status_code=201)
+
+@app.post("/transacciones/bulk")
+async def create_transacciones_bulk(request: Request, response: Response):
+    items = await read_bulk_body(request)
+    inserted, errors = await bulk_insert(db.transacciones, TransaccionIn, items)
+    bump_stats("transacciones", len(inserted))
+    await update_rollups("transacciones", inserted)
+    response.status_code = 207 if errors else 201
+    return {"received": len(items), "inserted": len(inserted), "errors": errors}
+
+# ============ BATCH GET ============
+class BatchGetIn(BaseModel):
+    ids: List[str]
+
+@app.post("/{collection}/batch-get")
+async def batch_get(collection: str, payload: BatchGetIn, expand: Optional[str] = None):
+    if collection not in COLLECTION_MODELS:
+        raise HTTPException(status_code=404, detail="Colección no encontrada")
+    if len(payload.ids) > BATCH_GET_MAX:
+        raise HTTPException(status_code=413, detail=f"Máximo {BATCH_GET_MAX} IDs por petición")
+    ids = list(dict.fromkeys(payload.ids))
+    found = await find_by(db[collection], "_id", ids)
+    docs = await expand_docs(collection, [found[i] for i in ids if i in found], expand)
+    return respond({"found": docs, "missing": [i for i in ids if i not in found]}, raw=True)
+
+# ============ SEARCH ============
+# mode=prefix usa el índice de `busqueda` (regex anclada = rango de índice);
+# mode=text usa el índice de texto en español ordenado por textScore; auto
+# prueba el prefijo y recurre al texto si no hay coincidencias.
+def rank_prefix(doc, term):
+    # Primero las que empiezan por el término desde la primera palabra,
+    # luego las coincidencias más cortas (más cercanas a lo escrito).
+    terms = doc.get("busqueda") or []
+    first = next((i for i, t in enumerate(terms) if t.startswith(term)), len(terms))
+    return first, len(terms[0]) if terms else 0
+
+async def search_prefix(collection, term, limit):
+    query = {"busqueda": {"$regex": "^" + re.escape(term)}}
+    fields = dict.fromkeys(SEARCH_FIELDS[collection] + ["busqueda"], 1)
+    docs = await db[collection].find(query, fields).limit(SEARCH_MAX_CANDIDATES).to_list(None)
+    docs.sort(key=lambda d: rank_prefix(d, term))
+    hits = []
+    for doc in docs[:limit]:
+        first, _ = rank_prefix(doc, term)
+        doc.pop("busqueda", None)
+        doc["score"] = 1.0 / (1 + first)
+        hits.append(safe_doc(doc))
+    return hits
+
+async def search_text(collection, q, limit):
+    fields = dict.fromkeys(SEARCH_FIELDS[collection], 1)
+    fields["score"] = {"$meta": "textScore"}
+    cursor = db[collection].find({"$text": {"$search": q}}, fields).sort([("score", {"$meta": "textScore"})])
+    return [safe_doc(d) for d in await cursor.limit(limit).to_list(None)]
+
+async def search_collection(collection, q, mode, limit):
+    term = normaliza(q)
+    if not term:
+        return []
+    if mode in ("prefix", "auto"):
+        hits = await search_prefix(collection, term, limit)
+        if hits or mode == "prefix":
+            return hits
+    return await search_text(collection, q, limit)
+
+@app.get("/search")
+async def search(q: str = Query(..., min_length=1), collections: Optional[str] = None,
+                 mode: Literal["auto", "prefix", "text"] = "auto", limit: int = Query(10, ge=1, le=50)):
+    names = [c.strip() for c in collections.split(",") if c.strip()] if collections else list(SEARCH_FIELDS)
+    unknown = [c for c in names if c not in SEARCH_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Colección sin búsqueda: {', '.join(unknown)}")
+    results = await asyncio.gather(*(search_collection(c, q, mode, limit) for c in names))
+    return respond(dict(zip(names, results)), raw=True)
+
+# ============ DOCUMENTS (búsqueda vectorial) ============
+# El índice lo construye scripts/vector_index.py; aquí se abre con mmap y se
+# recarga cuando cambia meta.json (cada refresh incremental).
+class VectorIndex:
+    def __init__(self, path):
+        self.path = path
+        self.state = None
+        self.meta_mtime = None
+
+    def _segment(self, name):
+        path = os.path.join(self.path, name)
+        with open(os.path.join(path, "ids.json"), "r", encoding="utf-8") as f:
+            ids = json_util.loads(f.read())
+        segment = {"ids": ids, "vectors": np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")}
+        if os.path.exists(os.path.join(path, "centroids.npy")):
+            segment["centroids"] = np.load(os.path.join(path, "centroids.npy"))
+            segment["offsets"] = np.load(os.path.join(path, "offsets.npy"))
+        return segment
+
+    def load_if_changed(self):
+        meta_path = os.path.join(self.path, "meta.json")
+        try:
+            mtime = os.stat(meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime != self.meta_mtime:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            delta = self._segment(meta["delta"]) if meta.get("delta") else None
+            # Un solo objeto: una búsqueda en curso no mezcla dos generaciones
+            self.state = {
+                "meta": meta,
+                "main": self._segment(meta["main"]),
+                "delta": delta,
+                "delta_ids": {str(i) for i in delta["ids"]} if delta else set(),
+            }
+            self.meta_mtime = mtime
+        return True
+
+    @staticmethod
+    def _top(vectors, query, k, rows=None):
+        scores = np.asarray(vectors @ query)
+        if len(scores) > k:
+            best = np.argpartition(-scores, k)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        return [((rows[i] if rows is not None else i), float(scores[i])) for i in best]
+
+    def search(self, vector, k, nprobe):
+        state = self.state
+        main, delta, delta_ids = state["main"], state["delta"], state["delta_ids"]
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        # Se piden de más por si algunos están reemplazados en el delta
+        want = k + len(delta_ids)
+        if "centroids" in main:
+            listas = np.argsort(-(main["centroids"] @ query))[:nprobe]
+            rows = np.concatenate([np.arange(main["offsets"][c], main["offsets"][c + 1]) for c in listas])
+            hits = self._top(main["vectors"][rows], query, want, rows)
+        else:
+            hits = self._top(main["vectors"], query, want)
+        results = [(main["ids"][i], s) for i, s in hits if str(main["ids"][i]) not in delta_ids]
+        if delta:
+            results += [(delta["ids"][i], s) for i, s in self._top(delta["vectors"], query, k)]
+        results.sort(key=lambda r: -r[1])
+        return results[:k]
+
+vector_index = VectorIndex(VECTOR_INDEX_DIR)
+
+class DocumentSearchIn(BaseModel):
+    vector: List[float]
+    k: int = Field(10, ge=1, le=100)
+    nprobe: Optional[int] = Field(None, ge=1)
+
+@app.post("/documents/search")
+async def search_documents(payload: DocumentSearchIn, expand: Optional[str] = None):
+    if np is None:
+        raise HTTPException(status_code=503, detail="Búsqueda vectorial no disponible: falta numpy")
+    if expand and expand != "related_medicamento":
+        raise HTTPException(status_code=400, detail=f"No se puede expandir: {expand}")
+    # Recargar tras un build lee ids.json y abre los .npy: fuera del event loop
+    if not await asyncio.to_thread(vector_index.load_if_changed):
+        raise HTTPException(status_code=503, detail="Índice vectorial no construido (scripts/vector_index.py)")
+    meta = vector_index.state["meta"]
+    if len(payload.vector) != meta["dim"]:
+        raise HTTPException(status_code=400, detail=f"El vector debe tener dimensión {meta['dim']}")
+    # La búsqueda es CPU (producto de matrices): fuera del event loop
+    hits = await asyncio.to_thread(vector_index.search, payload.vector, payload.k,
+                                   payload.nprobe or VECTOR_NPROBE)
+    projection = {"title": 1, "language": 1, "related_medicamento": 1}
+    docs = {str(d["_id"]): d async for d in db.documents.find({"_id": {"$in": [id for id, _ in hits]}}, projection)}
+    results = []
+    for id, score in hits:
+        doc = docs.get(str(id))
+        if doc is not None:
+            results.append(dict(safe_doc(doc), score=round(score, 6)))
+    if expand:
+        found = await find_by(db.medicamentos, "_id", {r["related_medicamento"] for r in results
+                                                       if r.get("related_medicamento")})
+        for r in results:
+            r["medicamento"] = found.get(r.get("related_medicamento"))
+    return respond({"results": results, "index_generation": meta["generation"]}, raw=True)
+
+# ============ HEALTH ============
+# /health: el proceso responde (liveness, sin tocar Mongo).
+# /ready: Mongo responde al ping; es la señal para enviarle tráfico.
+@app.get("/health")
+async def health():
+    return respond({"status": "ok", "pid": os.getpid()}, raw=True)
+
+@app.get("/ready")
+async def ready():
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), READY_TIMEOUT_MS / 1000)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Mongo no disponible: {e or type(e).__name__}")
+    return respond({
+        "status": "ready",
+        "pid": os.getpid(),
+        "workers": WEB_CONCURRENCY,
+        "max_pool_size": MONGO_MAX_POOL_SIZE,
+        **startup,
+    }, raw=True)
+
+# ============ PROPAGACIONES ============
+# citas y transacciones guardan copias de cliente, doctor, medicamento y
+# empleado. Un PATCH actualiza el documento de origen al momento y encola en
+# `propagaciones` un trabajo con la copia nueva; un worker en segundo plano
+# (ver lifespan) la aplica por lotes de PROPAGATION_BATCH_SIZE con una pausa
+# entre lotes. Cada lote elige documentos cuya copia aún difiere (filtro por
+# el ID referenciado, con índice, más $ne), así el trabajo es idempotente,
+# se puede reanudar y el mismo filtro mide lo que falta por actualizar.
+# Colección de origen de cada tipo (el empleado vive embebido en farmacias)
+PROPAGATION_SOURCES = {"cliente": "clientes", "doctor": "doctores", "medicamento": "medicamentos"}
+
+PROPAGATION_TARGETS = {
+    # tipo: [(colección, campo embebido, clave del ID, es arreglo)]
+    "cliente": [("citas", "cliente", "_id", False)],
+    "doctor": [("citas", "doctor", "_id", False)],
+    "medicamento": [("citas", "receta", "medicamento_id", True), ("inventario", None, "medicamento_id", False)],
+    "empleado": [("transacciones", "empleado", "_id", True)],
+}
+
+def embedded_copy(tipo, doc):
+    # Campos que cada colección copia del documento de origen
+    if tipo == "cliente":
+        return {"nombre": doc["nombre"], "telefono": doc["telefono"]}
+    if tipo == "doctor":
+        return {"nombre": f"{doc['nombre']} {doc['apellido']}", "especialidad": doc["especialidad"]}
+    if tipo == "medicamento":
+        return {"medicamento_nombre": doc["nombre"]}
+    return {"nombre": doc["nombre"], "puesto": doc["puesto"]}
+
+def propagation_targets(job):
+    id, copia = job["entidad_id"], job["copia"]
+    targets = []
+    for coleccion, campo, clave, en_arreglo in PROPAGATION_TARGETS[job["tipo"]]:
+        if en_arreglo:
+            stale = [{f: {"$ne": v}} for f, v in copia.items()]
+            filtro = {campo: {"$elemMatch": {clave: id, "$or": stale}}}
+            update = {"$set": {f"{campo}.$[e].{f}": v for f, v in copia.items()}}
+            array_filters = [{f"e.{clave}": id}]
+        else:
+            path = f"{campo}." if campo else ""
+            filtro = {path + clave: id, "$or": [{path + f: {"$ne": v}} for f, v in copia.items()]}
+            update = {"$set": {path + f: v for f, v in copia.items()}}
+            array_filters = None
+        targets.append({"coleccion": coleccion, "filtro": filtro, "update": update, "array_filters": array_filters})
+    # Lista de nombres embebida en farmacias (hasta migrar a inventario)
+    if job["tipo"] == "medicamento" and job.get("anteriores"):
+        nombre = copia["medicamento_nombre"]
+        targets.append({"coleccion": "farmacias", "filtro": {"medicamentos": {"$in": job["anteriores"]}},
+                        "update": {"$set": {"medicamentos.$[m]": nombre}},
+                        "array_filters": [{"m": {"$in": job["anteriores"]}}]})
+    return targets
+
+async def current_copy(tipo, entidad_id):
+    # La copia se toma del documento de origen al ejecutar el trabajo: dos
+    # PATCH concurrentes sobre campos distintos no pueden dejar una copia
+    # parcial, porque el trabajo que sobrevive lee el estado final.
+    if tipo == "empleado":
+        farmacia = await db.farmacias.find_one({"empleados._id": entidad_id}, {"empleados.$": 1})
+        doc = farmacia["empleados"][0] if farmacia else None
+    else:
+        doc = await db[PROPAGATION_SOURCES[tipo]].find_one({"_id": id_query(entidad_id)})
+    return embedded_copy(tipo, doc) if doc else None
+
+propagation_wakeup = asyncio.Event()
+
+async def enqueue_propagation(tipo, entidad_id, copia, anterior=None):
+    # Un trabajo nuevo lleva la copia completa, así reemplaza a los que
+    # sigan pendientes o en curso para la misma entidad.
+    anteriores = {anterior} if anterior and anterior != copia.get("medicamento_nombre") else set()
+    async for previo in db.propagaciones.find({"tipo": tipo, "entidad_id": entidad_id,
+                                               "estado": {"$in": ["pendiente", "en_curso"]}}, {"anteriores": 1}):
+        anteriores.update(previo.get("anteriores") or [])
+    await db.propagaciones.update_many(
+        {"tipo": tipo, "entidad_id": entidad_id, "estado": {"$in": ["pendiente", "en_curso"]}},
+        {"$set": {"estado": "reemplazado", "actualizado": datetime.now(timezone.utc)}})
+    job = {"_id": new_id(), "tipo": tipo, "entidad_id": entidad_id, "copia": copia,
+           "anteriores": sorted(anteriores), "estado": "pendiente", "creado": datetime.now(timezone.utc)}
+    job["progreso"] = [{"coleccion": t["coleccion"], "procesados": 0} for t in propagation_targets(job)]
+    await db.propagaciones.insert_one(job)
+    propagation_wakeup.set()
+    return job["_id"]
+
+async def claim_propagation():
+    now = datetime.now(timezone.utc)
+    return await db.propagaciones.find_one_and_update(
+        {"$or": [{"estado": "pendiente"}, {"estado": "en_curso", "lease_hasta": {"$lt": now}}]},
+        {"$set": {"estado": "en_curso", "iniciado": now, "lease_hasta": now + timedelta(seconds=PROPAGATION_LEASE_S)}},
+        sort=[("creado", ASCENDING)], return_document=ReturnDocument.AFTER)
+
+async def run_propagation(job):
+    copia = await current_copy(job["tipo"], job["entidad_id"])
+    if copia is not None and copia != job["copia"]:
+        job = {**job, "copia": copia}
+        await db.propagaciones.update_one({"_id": job["_id"], "estado": "en_curso"}, {"$set": {"copia": copia}})
+    for n, target in enumerate(propagation_targets(job) if copia is not None else []):
+        col = db[target["coleccion"]]
+        while True:
+            ids = [d["_id"] async for d in col.find(target["filtro"], {"_id": 1}).limit(PROPAGATION_BATCH_SIZE)]
+            if not ids:
+                break
+            result = await col.update_many({"_id": {"$in": ids}}, target["update"],
+                                           array_filters=target["array_filters"])
+            if result.modified_count and target["coleccion"] in CACHED_COLLECTIONS:
+                # ETag y claves de caché de esa colección (farmacias.medicamentos)
+                await bump_version(target["coleccion"])
+            now = datetime.now(timezone.utc)
+            # Si otro PATCH reemplazó el trabajo, se abandona (el nuevo sigue)
+            vigente = await db.propagaciones.update_one(
+                {"_id": job["_id"], "estado": "en_curso"},
+                {"$inc": {f"progreso.{n}.procesados": result.modified_count},
+                 "$set": {"actualizado": now, "lease_hasta": now + timedelta(seconds=PROPAGATION_LEASE_S)}})
+            if not vigente.matched_count:
+                return
+            if not result.modified_count:
+                break
+            await asyncio.sleep(PROPAGATION_PAUSE_MS / 1000)
+    await db.propagaciones.update_one(
+        {"_id": job["_id"], "estado": "en_curso"},
+        {"$set": {"estado": "completado", "completado": datetime.now(timezone.utc)}, "$unset": {"lease_hasta": ""}})
+
+async def propagation_worker():
+    while True:
+        try:
+            job = await claim_propagation()
+            if job is None:
+                propagation_wakeup.clear()
+                try:
+                    await asyncio.wait_for(propagation_wakeup.wait(), PROPAGATION_POLL_S)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await run_propagation(job)
+            except Exception as e:
+                # Vuelve a pendiente: el siguiente intento retoma lo que falte
+                await db.propagaciones.update_one(
+                    {"_id": job["_id"], "estado": "en_curso"},
+                    {"$set": {"estado": "pendiente", "error": str(e)}, "$inc": {"intentos": 1}})
+                raise
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.getLogger("pharmacien.propagaciones").warning("error en propagación: %s", e)
+            await asyncio.sleep(PROPAGATION_POLL_S)
+
+def job_summary(job, pendientes=None):
+    job = safe_doc(job)
+    fin = job.get("completado") or datetime.now(timezone.utc)
+    creado = job["creado"].replace(tzinfo=job["creado"].tzinfo or timezone.utc)
+    fin = fin.replace(tzinfo=fin.tzinfo or timezone.utc)
+    job["retraso_s"] = round((fin - creado).total_seconds(), 3)
+    if pendientes is not None:
+        job["pendientes"] = pendientes
+    return job
+
+@app.get("/propagaciones")
+async def get_propagaciones(response: Response, limit: int = Query(50, ge=1, le=100), skip: int = Query(0, ge=0),
+                            cursor: Optional[str] = None,
+                            estado: Optional[Literal["pendiente", "en_curso", "completado", "reemplazado"]] = None):
+    query = {"estado": estado} if estado else {}
+    jobs = await paginate(db.propagaciones, response, limit, skip, cursor, query=query)
+    return respond([job_summary(j) for j in jobs], response, raw=True)
+
+@app.get("/propagaciones/estado")
+async def get_propagaciones_estado():
+    # Resumen de desfase: trabajos por estado y el pendiente más antiguo
+    por_estado = {d["_id"]: d["n"] async for d in await db.propagaciones.aggregate(
+        [{"$group": {"_id": "$estado", "n": {"$sum": 1}}}])}
+    oldest = await db.propagaciones.find_one({"estado": {"$in": ["pendiente", "en_curso"]}},
+                                             sort=[("creado", ASCENDING)])
+    return respond({
+        "por_estado": por_estado,
+        "retraso_max_s": job_summary(oldest)["retraso_s"] if oldest else 0.0,
+        "mas_antiguo": safe_doc(oldest)["_id"] if oldest else None,
+    }, raw=True)
+
+@app.get("/propagaciones/{id}")
+async def get_propagacion(id: str):
+    job = await db.propagaciones.find_one({"_id": id_query(id)})
+    if not job:
+        raise HTTPException(status_code=404, detail="Propagación no encontrada")
+    # Documentos cuya copia todavía difiere, por colección (consulta con índice)
+    counts = await asyncio.gather(*(db[t["coleccion"]].count_documents(t["filtro"])
+                                    for t in propagation_targets(job)))
+    pendientes = {t["coleccion"]: n for t, n in zip(propagation_targets(job), counts)}
+    return respond(job_summary(job, pendientes), raw=True)
+
+def patch_changes(payload):
+    # Los campos de los *Patch son Optional solo para poder omitirlos: un
+    # null explícito borraría un campo obligatorio (y se copiaría a citas y
+    # transacciones), así que se rechaza.
+    changes = model_dict(payload, exclude_unset=True)
+    if not changes:
+        raise HTTPException(status_code=400, detail="Sin campos para actualizar")
+    nulos = sorted(f for f, v in changes.items() if v is None)
+    if nulos:
+        raise HTTPException(status_code=400, detail=f"Campos que no admiten null: {', '.join(nulos)}")
+    return changes
+
+async def patch_source(collection, id, payload, not_found):
+    # before y after salen de la misma actualización atómica
+    changes = patch_changes(payload)
+    before = await db[collection].find_one_and_update({"_id": id_query(id)}, {"$set": changes},
+                                                      return_document=ReturnDocument.BEFORE)
+    if not before:
+        raise HTTPException(status_code=404, detail=not_found)
+    after = {**before, **changes}
+    campos = SEARCH_FIELDS.get(collection, [])
+    if any(f in changes for f in campos):
+        # Solo si el nombre sigue igual: si otro PATCH lo cambió entretanto,
+        # su propio cálculo de `busqueda` es el que vale.
+        after["busqueda"] = search_terms(collection, after)
+        await db[collection].update_one({"_id": before["_id"], **{f: after.get(f) for f in campos}},
+                                        {"$set": {"busqueda": after["busqueda"]}})
+    if collection in CACHED_COLLECTIONS:
+        await bump_version(collection)
+    return before, after
+
+async def propagate_if_changed(tipo, before, after, response, anterior=None):
+    # Las referencias embebidas guardan el _id de origen como texto
+    copia = embedded_copy(tipo, after)
+    if copia != embedded_copy(tipo, before):
+        job_id = await enqueue_propagation(tipo, str(before["_id"]), copia, anterior)
+        response.headers["X-Propagacion-Id"] = str(job_id)
+
+@app.patch("/clientes/{id}", response_model=ClienteOut)
+async def patch_cliente(id: str, payload: ClientePatch, response: Response):
+    before, after = await patch_source("clientes", id, payload, "Cliente no encontrado")
+    await propagate_if_changed("cliente", before, after, response)
+    return respond(safe_doc(after), response)
+
+@app.patch("/doctores/{id}", response_model=DoctorOut)
+async def patch_doctor(id: str, payload: DoctorPatch, response: Response):
+    before, after = await patch_source("doctores", id, payload, "Doctor no encontrado")
+    await propagate_if_changed("doctor", before, after, response)
+    return respond(safe_doc(after), response)
+
+@app.patch("/medicamentos/{id}", response_model=MedicamentoOut)
+async def patch_medicamento(id: str, payload: MedicamentoPatch, response: Response):
+    before, after = await patch_source("medicamentos", id, payload, "Medicamento no encontrado")
+    await propagate_if_changed("medicamento", before, after, response, anterior=before["nombre"])
+    return respond(safe_doc(after), response)
+
+@app.patch("/empleados/{id}", response_model=EmpleadoEmbed)
+async def patch_empleado(id: str, payload: EmpleadoPatch, response: Response):
+    # El empleado de origen vive embebido en sus farmacias (puede estar en
+    # varias): se actualizan todas las copias a la vez.
+    changes = patch_changes(payload)
+    farmacia = await db.farmacias.find_one({"empleados._id": id}, {"empleados.$": 1})
+    if not farmacia:
+        raise HTTPException(status_code=404, detail="Empleado no encontrado")
+    before = farmacia["empleados"][0]
+    await db.farmacias.update_many(
+        {"empleados._id": id}, {"$set": {f"empleados.$[e].{f}": v for f, v in changes.items()}},
+        array_filters=[{"e._id": id}])
+    after = {**before, **changes}
+    await bump_version("farmacias")
+    await propagate_if_changed("empleado", before, after, response)
+    return respond(after, response)
 
 # ============ STATS ============
+STATS_COLLECTIONS = ["proveedores", "medicamentos", "farmacias", "clientes", "doctores", "citas", "transacciones"]
+
+# Conteos estimados (metadatos de la colección) cacheados STATS_TTL segundos
+# y ajustados con las inserciones que hace esta misma API.
+_stats = {"expires": 0.0, "counts": None}
+
+def bump_stats(collection, n=1):
+    counts = _stats["counts"]
+    if counts is not None and collection in counts:
+        counts[collection] += n
+
 @app.get("/stats")
-def get_stats():
+async def get_stats(exact: bool = False):
+    if exact:
+        counts = await asyncio.gather(*(db[c].count_documents({}) for c in STATS_COLLECTIONS))
+        return dict(zip(STATS_COLLECTIONS, counts))
+    now = time.monotonic()
+    if _stats["counts"] is None or _stats["expires"] < now:
+        counts = await asyncio.gather(*(db[c].estimated_document_count() for c in STATS_COLLECTIONS))
+        _stats["counts"] = dict(zip(STATS_COLLECTIONS, counts))
+        _stats["expires"] = now + STATS_TTL
+    return dict(_stats["counts"])
+
+# ============ ANALYTICS ============
+# Las agregaciones se ejecutan en Mongo y el resultado se cachea por
+# endpoint + ventana de tiempo + parámetros. Con source=rollup se leen los
+# rollups diarios materializados (coste proporcional a los días, no a las
+# transacciones); la ventana se redondea a días completos.
+async def run_analytics(name, collection, pipeline, params, allow_disk_use, max_time_ms):
+    key = f"{name}:{json_util.dumps(params, sort_keys=True)}"
+    rows = await analytics_cache.get(key)
+    if rows is not None:
+        return rows
+    try:
+        cursor = await collection.aggregate(pipeline, allowDiskUse=allow_disk_use, maxTimeMS=max_time_ms)
+        rows = await cursor.to_list(None)
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail="La agregación excedió max_time_ms")
+    await analytics_cache.set(key, rows)
+    return rows
+
+def match_fecha(desde, hasta):
+    if desde or hasta:
+        return [{"$match": {"fecha": date_range(desde, hasta)}}]
+    return []
+
+def match_dia(desde, hasta):
+    dias = {}
+    if desde:
+        dias["$gte"] = dia_de(desde)
+    if hasta:
+        midnight = hasta.hour == hasta.minute == hasta.second == hasta.microsecond == 0
+        dias["$lt" if midnight else "$lte"] = dia_de(hasta)
+    return [{"$match": {"_id.dia": dias}}] if dias else []
+
+@app.get("/analytics/ventas/diarias")
+async def get_ventas_diarias(desde: Optional[datetime] = None, hasta: Optional[datetime] = None,
+                             source: Literal["raw", "rollup"] = "raw", allow_disk_use: bool = False,
+                             max_time_ms: int = Query(ANALYTICS_MAX_TIME_MS, gt=0)):
+    if source == "rollup":
+        collection = db.rollup_ventas_metodo
+        pipeline = match_dia(desde, hasta) + [
+            {"$project": {"_id": 0, "dia": "$_id.dia", "metodopago": "$_id.metodopago",
+                          "total": {"$round": ["$total", 2]}, "transacciones": 1}},
+        ]
+    else:
+        collection = db.transacciones
+        pipeline = match_fecha(desde, hasta) + [
+            {"$group": {
+                "_id": {"dia": {"$dateToString": {"format": "%Y-%m-%d", "date": "$fecha"}}, "metodopago": "$metodopago"},
+                "total": {"$sum": "$totalpagado"},
+                "transacciones": {"$sum": 1},
+            }},
+            {"$project": {"_id": 0, "dia": "$_id.dia", "metodopago": "$_id.metodopago",
+                          "total": {"$round": ["$total", 2]}, "transacciones": 1}},
+        ]
+    pipeline.append({"$sort": {"dia": 1, "metodopago": 1}})
+    params = {"desde": desde, "hasta": hasta, "source": source}
+    return await run_analytics("ventas_diarias", collection, pipeline, params, allow_disk_use, max_time_ms)
+
+@app.get("/analytics/ventas/por-metodo")
+async def get_ventas_por_metodo(desde: Optional[datetime] = None, hasta: Optional[datetime] = None,
+                                source: Literal["raw", "rollup"] = "raw", allow_disk_use: bool = False,
+                                max_time_ms: int = Query(ANALYTICS_MAX_TIME_MS, gt=0)):
+    if source == "rollup":
+        collection = db.rollup_ventas_metodo
+        pipeline = match_dia(desde, hasta) + [
+            {"$group": {"_id": "$_id.metodopago", "total": {"$sum": "$total"}, "transacciones": {"$sum": "$transacciones"}}},
+        ]
+    else:
+        collection = db.transacciones
+        pipeline = match_fecha(desde, hasta) + [
+            {"$group": {"_id": "$metodopago", "total": {"$sum": "$totalpagado"}, "transacciones": {"$sum": 1}}},
+        ]
+    pipeline += [
+        {"$project": {"_id": 0, "metodopago": "$_id", "total": {"$round": ["$total", 2]}, "transacciones": 1}},
+        {"$sort": {"total": -1}},
+    ]
+    params = {"desde": desde, "hasta": hasta, "source": source}
+    return await run_analytics("ventas_por_metodo", collection, pipeline, params, allow_disk_use, max_time_ms)
+
+@app.get("/analytics/ventas/por-empleado")
+async def get_ventas_por_empleado(desde: Optional[datetime] = None, hasta: Optional[datetime] = None,
+                                  limit: int = Query(20, ge=1, le=500), source: Literal["raw", "rollup"] = "raw",
+                                  allow_disk_use: bool = False,
+                                  max_time_ms: int = Query(ANALYTICS_MAX_TIME_MS, gt=0)):
+    if source == "rollup":
+        collection = db.rollup_ventas_empleado
+        pipeline = match_dia(desde, hasta) + [
+            {"$group": {
+                "_id": "$_id.empleado_id",
+                "nombre": {"$last": "$nombre"},
+                "total": {"$sum": "$total"},
+                "transacciones": {"$sum": "$transacciones"},
+            }},
+        ]
+    else:
+        collection = db.transacciones
+        pipeline = match_fecha(desde, hasta) + [
+            {"$unwind": "$empleado"},
+            {"$group": {
+                "_id": "$empleado._id",
+                "nombre": {"$first": "$empleado.nombre"},
+                "total": {"$sum": "$totalpagado"},
+                "transacciones": {"$sum": 1},
+            }},
+        ]
+    pipeline += [
+        {"$sort": {"total": -1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "empleado_id": "$_id", "nombre": 1,
+                      "total": {"$round": ["$total", 2]}, "transacciones": 1}},
+    ]
+    params = {"desde": desde, "hasta": hasta, "limit": limit, "source": source}
+    return await run_analytics("ventas_por_empleado", collection, pipeline, params, allow_disk_use, max_time_ms)
+
+@app.get("/analytics/medicamentos/top")
+async def get_medicamentos_top(desde: Optional[datetime] = None, hasta: Optional[datetime] = None,
+                               limit: int = Query(20, ge=1, le=500), source: Literal["raw", "rollup"] = "raw",
+                               allow_disk_use: bool = False,
+                               max_time_ms: int = Query(ANALYTICS_MAX_TIME_MS, gt=0)):
+    if source == "rollup":
+        collection = db.rollup_prescripciones
+        pipeline = match_dia(desde, hasta) + [
+            {"$group": {
+                "_id": "$_id.medicamento_id",
+                "nombre": {"$last": "$nombre"},
+                "prescripciones": {"$sum": "$prescripciones"},
+            }},
+        ]
+    else:
+        collection = db.citas
+        pipeline = match_fecha(desde, hasta) + [
+            {"$unwind": "$receta"},
+            {"$group": {
+                "_id": "$receta.medicamento_id",
+                "nombre": {"$first": "$receta.medicamento_nombre"},
+                "prescripciones": {"$sum": 1},
+            }},
+        ]
+    pipeline += [
+        {"$sort": {"prescripciones": -1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "medicamento_id": "$_id", "nombre": 1, "prescripciones": 1}},
+    ]
+    params = {"desde": desde, "hasta": hasta, "limit": limit, "source": source}
+    return await run_analytics("medicamentos_top", collection, pipeline, params, allow_disk_use, max_time_ms)
+
+# ============ METRICS ============
+# Middleware ASGI pura (sin BaseHTTPMiddleware, que añade una tarea por
+# petición). La etiqueta de ruta es la plantilla ("/citas/{id}") para que
+# la cardinalidad no crezca con los IDs.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timing = {"mongo": 0.0, "render": 0.0}
+        token = request_timing.set(timing)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - t0
+            request_timing.reset(token)
+            route = scope.get("route")
+            labels = {"method": scope["method"], "route": getattr(route, "path", "unmatched")}
+            metrics.observe("http_request_duration_seconds", labels, elapsed)
+            metrics.observe("http_request_mongo_seconds", labels, timing["mongo"])
+            metrics.observe("http_request_render_seconds", labels, timing["render"])
+            metrics.inc("http_requests_total", dict(labels, status=str(status)))
+
+app.add_middleware(MetricsMiddleware)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    metrics.set("cache_hits", {"backend": cache.name}, cache.hits)
+    metrics.set("cache_misses", {"backend": cache.name}, cache.misses)
+    metrics.set("analytics_cache_hits", {}, analytics_cache.hits)
+    metrics.set("analytics_cache_misses", {}, analytics_cache.misses)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# ============ CACHE ============
+@app.get("/cache/stats")
+async def get_cache_stats():
     return {
-        "proveedores": db.proveedores.count_documents({}),
-        "medicamentos": db.medicamentos.count_documents({}),
-        "farmacias": db.farmacias.count_documents({}),
-        "clientes": db.clientes.count_documents({}),
-        "doctores": db.doctores.count_documents({}),
-        "citas": db.citas.count_documents({}),
-        "transacciones": db.transacciones.count_documents({})
+        **await cache_stats(cache),
+        "analytics": await cache_stats(analytics_cache),
     }
+
+async def cache_stats(c):
+    total = c.hits + c.misses
+    return {
+        "backend": c.name,
+        "size": await c.size(),
+        "hits": c.hits,
+        "misses": c.misses,
+        "hit_ratio": round(c.hits / total, 4) if total else 0.0,
+    }
+
+# ============ EXPORT ============
+# Los generadores leen del cursor del servidor lote a lote y emiten un
+# chunk por lote, así la memoria no depende del tamaño de la colección.
+async def export_ndjson(cursor):
+    lines = []
+    async for doc in cursor:
+        lines.append(json.dumps(doc, ensure_ascii=False, default=json_default))
+        if len(lines) >= EXPORT_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+async def export_csv(cursor, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    pending = 1
+    async for doc in cursor:
+        row = []
+        for col in columns:
+            value = doc.get(col)
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, ensure_ascii=False, default=json_default)
+            elif isinstance(value, datetime):
+                value = value.isoformat()
+            row.append("" if value is None else value)
+        writer.writerow(row)
+        pending += 1
+        if pending >= EXPORT_BATCH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if pending:
+        yield buffer.getvalue()
+
+@app.get("/export/{collection}")
+async def export_collection(collection: str, format: Literal["ndjson", "csv"] = "ndjson"):
+    if collection not in COLLECTION_MODELS:
+        raise HTTPException(status_code=404, detail="Colección no encontrada")
+    # `busqueda` es interna (índice de /search), no forma parte del export
+    cursor = db[collection].find({}, {"busqueda": 0}, batch_size=EXPORT_BATCH_SIZE)
+    headers = {"Content-Disposition": f'attachment; filename="{collection}.{format}"'}
+    if format == "csv":
+        columns = ["_id"] + model_fields(COLLECTION_MODELS[collection])
+        return StreamingResponse(export_csv(cursor, columns), media_type="text/csv", headers=headers)
+    return StreamingResponse(export_ndjson(cursor), media_type="application/x-ndjson", headers=headers)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# scripts/bench_async.py
+# Prueba de carga: ruta síncrona (MongoClient dentro del threadpool de
+# FastAPI/anyio) contra ruta asíncrona (AsyncMongoClient) con N clientes
+# concurrentes haciendo lecturas por _id.
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+import anyio.to_thread
+from pymongo import MongoClient, AsyncMongoClient
+from dotenv import load_dotenv
+
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def drive(request, clients, duration):
+    latencias = []
+    fin = time.perf_counter() + duration
+
+    async def worker():
+        while time.perf_counter() < fin:
+            t0 = time.perf_counter()
+            await request()
+            latencias.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    elapsed = time.perf_counter() - t0
+    return {
+        "requests": len(latencias),
+        "rps": len(latencias) / elapsed,
+        "p50_ms": statistics.median(latencias) if latencias else 0.0,
+        "p99_ms": percentile(latencias, 99),
+    }
+
+
+async def run_sync(ids, args):
+    col = MongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE)[DB_NAME][args.collection]
+    # Igual que una ruta `def` de FastAPI: cada petición ocupa un hilo del
+    # limitador de anyio (40 por defecto) durante todo el round-trip.
+    anyio.to_thread.current_default_thread_limiter().total_tokens = args.threads
+
+    async def request():
+        await anyio.to_thread.run_sync(col.find_one, {"_id": random.choice(ids)})
+
+    return await drive(request, args.clients, args.duration)
+
+
+async def run_async(ids, args):
+    col = AsyncMongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE)[DB_NAME][args.collection]
+
+    async def request():
+        await col.find_one({"_id": random.choice(ids)})
+
+    return await drive(request, args.clients, args.duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Comparación de throughput sync vs async")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=15.0, help="Segundos por modo")
+    parser.add_argument("--threads", type=int, default=40, help="Tamaño del threadpool en modo sync")
+    parser.add_argument("--collection", default="medicamentos")
+    args = parser.parse_args()
+
+    ids = [d["_id"] for d in MongoClient(MONGO_URI)[DB_NAME][args.collection].find({}, {"_id": 1}).limit(10000)]
+    if not ids:
+        raise SystemExit(f"La colección {args.collection} está vacía; ejecuta ingest_dataset.py primero")
+
+    print(f"{args.clients} clientes concurrentes, {args.duration}s por modo, pool={MONGO_MAX_POOL_SIZE}")
+    print(f"{'modo':>6} {'peticiones':>11} {'req/s':>10} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    for modo, runner in (("sync", run_sync), ("async", run_async)):
+        r = anyio.run(runner, ids, args)
+        print(f"{modo:>6} {r['requests']:>11} {r['rps']:>10.0f} {r['p50_ms']:>10.2f} {r['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# scripts/bench_ids.py
+# Compara los formatos de _id de ID_MODE (uuid en texto, UUID binario y
+# ObjectId) insertando N documentos tipo transacción en una colección por
+# modo: throughput de inserción (total y del último 10 %, donde se nota el
+# coste de insertar claves aleatorias en un índice grande) y tamaño del
+# índice _id y de la colección.
+import argparse
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import MongoClient
+from dotenv import load_dotenv
+
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
+
+ID_FACTORIES = {
+    "uuid": lambda: str(uuid.uuid4()),
+    "binary": uuid.uuid4,
+    "objectid": ObjectId,
+}
+
+
+def make_doc(rng, new_id, i):
+    return {
+        "_id": new_id(),
+        "fecha": datetime(2024, 1, 1) + timedelta(seconds=i),
+        "totalpagado": round(rng.uniform(100.0, 5000.0), 2),
+        "metodopago": rng.choice(["Efectivo", "Tarjeta", "Transferencia"]),
+    }
+
+
+def run(db, mode, total, batch_size):
+    col = db[f"bench_ids_{mode}"]
+    col.drop()
+    rng = random.Random(42)
+    new_id = ID_FACTORIES[mode]
+    tail_start = int(total * 0.9)
+    t0 = time.perf_counter()
+    tail_t0 = None
+    for start in range(0, total, batch_size):
+        if tail_t0 is None and start >= tail_start:
+            tail_t0 = time.perf_counter()
+        col.insert_many([make_doc(rng, new_id, i) for i in range(start, min(start + batch_size, total))],
+                        ordered=False)
+    end = time.perf_counter()
+    tail_t0 = tail_t0 or t0
+
+    stats = next(col.aggregate([{"$collStats": {"storageStats": {}}}]))["storageStats"]
+    result = {
+        "mode": mode,
+        "docs_per_s": total / (end - t0),
+        "tail_docs_per_s": (total - tail_start) / (end - tail_t0) if end > tail_t0 else 0.0,
+        "id_index_mb": stats["indexSizes"].get("_id_", 0) / (1 << 20),
+        "storage_mb": stats["storageSize"] / (1 << 20),
+        "avg_doc_bytes": stats.get("avgObjSize", 0),
+    }
+    col.drop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tamaño de índice y throughput de inserción por formato de _id")
+    parser.add_argument("--docs", type=int, default=10_000_000)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--modes", default="uuid,binary,objectid")
+    args = parser.parse_args()
+
+    db = MongoClient(MONGO_URI, uuidRepresentation="standard")[DB_NAME]
+    print(f"{args.docs:,} documentos por modo, lotes de {args.batch_size}")
+    print(f"{'modo':>9} {'docs/s':>10} {'últ. 10%':>10} {'índice _id (MB)':>16} {'colección (MB)':>15} {'doc (B)':>8}")
+    for mode in args.modes.split(","):
+        r = run(db, mode, args.docs, args.batch_size)
+        print(f"{r['mode']:>9} {r['docs_per_s']:>10,.0f} {r['tail_docs_per_s']:>10,.0f} "
+              f"{r['id_index_mb']:>16.1f} {r['storage_mb']:>15.1f} {r['avg_doc_bytes']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
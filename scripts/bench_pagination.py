@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# scripts/bench_pagination.py
+# Compara la latencia de skip/limit contra paginación por cursor (keyset)
+# a distintas profundidades de página, sobre un mongod local.
+import argparse
+import os
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo import MongoClient, ASCENDING
+from dotenv import load_dotenv
+
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
+
+BENCH_COLLECTION = "bench_paginacion"
+
+
+def seed(col, total, batch=10000):
+    col.drop()
+    inicio = datetime(2024, 1, 1)
+    docs = []
+    for i in range(total):
+        docs.append({
+            "_id": str(uuid.uuid4()),
+            "fecha": inicio + timedelta(minutes=i % 500000),
+            "totalpagado": float(i % 5000),
+            "metodopago": "Efectivo",
+        })
+        if len(docs) == batch:
+            col.insert_many(docs, ordered=False)
+            docs = []
+    if docs:
+        col.insert_many(docs, ordered=False)
+    col.create_index([("fecha", ASCENDING), ("_id", ASCENDING)])
+
+
+def timed(fn, repeats):
+    muestras = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        muestras.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(muestras)
+
+
+def page_skip(col, depth, limit):
+    sort = [("fecha", ASCENDING), ("_id", ASCENDING)]
+    return list(col.find().sort(sort).skip(depth).limit(limit))
+
+
+def page_keyset(col, key, limit):
+    sort = [("fecha", ASCENDING), ("_id", ASCENDING)]
+    query = {}
+    if key:
+        query = {"$or": [
+            {"fecha": {"$gt": key["fecha"]}},
+            {"fecha": key["fecha"], "_id": {"$gt": key["_id"]}},
+        ]}
+    return list(col.find(query).sort(sort).limit(limit))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de paginación skip vs cursor")
+    parser.add_argument("--docs", type=int, default=500000)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--depths", default="0,1000,10000,100000,250000,450000")
+    parser.add_argument("--keep", action="store_true", help="No borrar la colección de prueba al terminar")
+    args = parser.parse_args()
+
+    client = MongoClient(MONGO_URI)
+    col = client[DB_NAME][BENCH_COLLECTION]
+
+    print(f"Sembrando {args.docs} documentos en {DB_NAME}.{BENCH_COLLECTION}...")
+    seed(col, args.docs)
+
+    print(f"\n{'profundidad':>12} {'skip (ms)':>12} {'cursor (ms)':>12}")
+    for depth in (int(d) for d in args.depths.split(",")):
+        if depth >= args.docs:
+            continue
+        # La clave del documento anterior a la página equivale al token next_cursor
+        key = None
+        if depth:
+            key = page_skip(col, depth - 1, 1)[0]
+        t_skip = timed(lambda: page_skip(col, depth, args.limit), args.repeats)
+        t_keyset = timed(lambda: page_keyset(col, key, args.limit), args.repeats)
+        print(f"{depth:>12} {t_skip:>12.2f} {t_keyset:>12.2f}")
+
+    if not args.keep:
+        col.drop()
+
+
+if __name__ == "__main__":
+    main()
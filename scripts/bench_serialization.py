@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# scripts/bench_serialization.py
+# Microbenchmark del coste de CPU por petición de serializar una página de
+# cada modelo: validación con response_model (List[...Out] + jsonable_encoder)
+# contra la codificación directa de api/app.py (FastJSONResponse). Las rutas
+# se montan en una app FastAPI de prueba y se invocan directamente por ASGI
+# (sin cliente HTTP que añada ruido) con documentos del generador, así no
+# hace falta un mongod.
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from typing import List
+from fastapi import FastAPI
+
+import generate_dataset_pharmacien as generator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+import app as api  # noqa: E402
+
+OUT_MODELS = {
+    "proveedores": api.ProveedorOut,
+    "medicamentos": api.MedicamentoOut,
+    "clientes": api.ClienteOut,
+    "doctores": api.DoctorOut,
+    "farmacias": api.FarmaciaOut,
+    "citas": api.CitaOut,
+    "transacciones": api.TransaccionOut,
+}
+
+
+def routes(docs):
+    # Cierre y no argumento por defecto: FastAPI tomaría `docs` como parámetro
+    async def validated():
+        return docs
+
+    async def fast():
+        return api.FastJSONResponse(docs)
+
+    return validated, fast
+
+
+def build_app(pages):
+    bench = FastAPI()
+    for collection, model in OUT_MODELS.items():
+        validated, fast = routes(pages[collection])
+        bench.add_api_route(f"/validated/{collection}", validated, response_model=List[model])
+        bench.add_api_route(f"/fast/{collection}", fast)
+    return bench
+
+
+async def call(app, path):
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+             "query_string": b"", "headers": [], "client": ("bench", 0), "server": ("bench", 80)}
+    body = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return b"".join(body)
+
+
+async def measure(app, path, requests):
+    cpu = []
+    for _ in range(requests):
+        t0 = time.process_time()
+        body = await call(app, path)
+        cpu.append((time.process_time() - t0) * 1000)
+    return statistics.median(cpu), len(body)
+
+
+async def run(args):
+    counts = {name: max(n, args.page_size) for name, n in generator.DEFAULT_COUNTS.items()}
+    pages = {c: [generator.MAKERS[c](args.seed, counts, i) for i in range(args.page_size)] for c in OUT_MODELS}
+    bench = build_app(pages)
+    encoder = "orjson" if api.orjson is not None else "json"
+    print(f"Páginas de {args.page_size} documentos, {args.requests} peticiones por ruta, codificador={encoder}")
+    print(f"{'modelo':>15} {'validado (ms)':>14} {'directo (ms)':>13} {'speedup':>8} {'bytes':>8}")
+    for collection, model in OUT_MODELS.items():
+        fast_ms, size = await measure(bench, f"/fast/{collection}", args.requests)
+        try:
+            validated_ms, _ = await measure(bench, f"/validated/{collection}", args.requests)
+        except Exception as e:
+            # Los documentos no cumplen el modelo de salida: con
+            # RESPONSE_VALIDATION activado esta ruta respondería 500.
+            print(f"{model.__name__:>15} {'error':>14} {fast_ms:>13.3f} {'-':>8} {size:>8}  ({type(e).__name__})")
+            continue
+        print(f"{model.__name__:>15} {validated_ms:>14.3f} {fast_ms:>13.3f} "
+              f"{validated_ms / fast_ms if fast_ms else 0:>7.1f}x {size:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU por petición: response_model contra serialización directa")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
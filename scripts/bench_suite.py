@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# scripts/bench_suite.py
+# Suite de benchmarks reproducible para comparar commits: para cada escala
+# genera el dataset con una semilla fija, lo carga con ingest_dataset en una
+# base de datos aparte (docs/s), levanta la API con uvicorn contra esa base
+# y lanza cada familia de endpoints (listados, lectura por _id, altas,
+# /stats e inserción individual frente a /bulk) con concurrencia fija. El
+# resultado (p50/p95/p99, req/s, docs/s, errores y RSS del servidor) se
+# escribe como JSON.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import httpx
+from pymongo import MongoClient
+from dotenv import load_dotenv
+
+import generate_dataset_pharmacien as generator
+import ingest_dataset
+from create_indexes_and_validators import INDEX_SPECS, apply_indexes
+
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(SCRIPTS_DIR, "..", "api")
+
+# Rutas de cada familia de endpoints
+LIST_PATHS = [
+    "/medicamentos?limit=50",
+    "/farmacias?limit=50",
+    "/citas?limit=50",
+    "/transacciones?limit=50",
+    "/clientes?limit=50",
+]
+BY_ID_COLLECTIONS = ["medicamentos", "clientes", "citas", "transacciones"]
+# Colecciones con POST /<colección> y POST /<colección>/bulk
+INSERT_COLLECTIONS = ["transacciones", "citas"]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def rss_mb(pid):
+    # RSS del proceso del servidor (Linux: /proc; en otros sistemas, psutil si está)
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / (1 << 20)
+    except Exception:
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SCRIPTS_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def seed_database(db_name, scale, seed, workers, batch_size):
+    client = MongoClient(MONGO_URI)
+    client.drop_database(db_name)
+    db = client[db_name]
+    counts = {name: max(1, int(n * scale)) for name, n in generator.DEFAULT_COUNTS.items()}
+
+    tmpdir = tempfile.mkdtemp(prefix="pharmacien_bench_")
+    try:
+        t0 = time.perf_counter()
+        out, manifest = generator.generate(counts, seed, "ndjson", os.path.join(tmpdir, "ndjson"), workers)
+        generate_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        progress = ingest_dataset.ingest(db, out, workers, batch_size)
+        ingest_s = time.perf_counter() - t0
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    for collection in INDEX_SPECS:
+        apply_indexes(db, collection)
+
+    inserted = sum(progress.inserted.values())
+    return db, {
+        "counts": manifest["counts"],
+        "generate_seconds": round(generate_s, 3),
+        "ingest_seconds": round(ingest_s, 3),
+        "ingest_docs_per_s": round(inserted / ingest_s, 1) if ingest_s else None,
+        "ingest_errors": sum(progress.errors.values()),
+    }
+
+
+def start_server(db_name, port, workers):
+    # WEB_CONCURRENCY reparte MONGO_POOL_BUDGET entre los workers de la API
+    env = dict(os.environ, DB_NAME=db_name, WEB_CONCURRENCY=str(workers))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--app-dir", API_DIR, "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        env=env,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"uvicorn terminó con código {proc.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/ready", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("La API no respondió en 30 s")
+
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+async def drive(client, make_request, concurrency, duration):
+    latencias = []
+    errores = 0
+    docs = 0
+    fin = time.perf_counter() + duration
+
+    async def worker(rng):
+        nonlocal errores, docs
+        while time.perf_counter() < fin:
+            method, path, body = make_request(rng)
+            t0 = time.perf_counter()
+            try:
+                r = await client.request(method, path, json=body)
+                ok = r.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            latencias.append((time.perf_counter() - t0) * 1000)
+            if not ok:
+                errores += 1
+            elif method == "POST":
+                docs += len(body) if isinstance(body, list) else 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(random.Random(i)) for i in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    return {
+        "requests": len(latencias),
+        "errors": errores,
+        "rps": round(len(latencias) / elapsed, 1),
+        "docs_per_s": round(docs / elapsed, 1),
+        "p50_ms": round(statistics.median(latencias), 3) if latencias else 0.0,
+        "p95_ms": round(percentile(latencias, 95), 3),
+        "p99_ms": round(percentile(latencias, 99), 3),
+    }
+
+
+def request_families(db, bulk_size):
+    ids = {c: [d["_id"] for d in db[c].find({}, {"_id": 1}).limit(10000)] for c in BY_ID_COLLECTIONS}
+    ids = {c: v for c, v in ids.items() if v}
+    clientes = list(db.clientes.find({}, {"nombre": 1, "telefono": 1}).limit(1000))
+    doctores = list(db.doctores.find({}, {"nombre": 1, "apellido": 1, "especialidad": 1}).limit(1000))
+    empleados = [e for f in db.farmacias.find({}, {"empleados": 1}).limit(1000) for e in f.get("empleados", [])]
+    medicamentos = list(db.medicamentos.find({}, {"nombre": 1}).limit(1000))
+
+    def listado(rng):
+        return "GET", rng.choice(LIST_PATHS), None
+
+    def por_id(rng):
+        collection = rng.choice(list(ids))
+        return "GET", f"/{collection}/{rng.choice(ids[collection])}", None
+
+    def alta(rng):
+        return "POST", "/clientes", {
+            "nombre": f"Bench {rng.randrange(10**9)}",
+            "direccion": "Calle Benchmark 1",
+            "telefono": f"+52-{rng.randint(100, 999)}-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}",
+        }
+
+    def stats(rng):
+        return "GET", "/stats", None
+
+    # Documentos de citas/transacciones con referencias reales del dataset
+    def transaccion(rng):
+        return {
+            "fecha": datetime(2025, rng.randint(1, 12), rng.randint(1, 28), tzinfo=timezone.utc).isoformat(),
+            "totalpagado": round(rng.uniform(100.0, 5000.0), 2),
+            "metodopago": rng.choice(generator.metodos_pago),
+            "empleado": [rng.choice(empleados)],
+            "citaref": rng.choice(ids["citas"]) if ids.get("citas") else None,
+        }
+
+    def cita(rng):
+        cliente = rng.choice(clientes)
+        doctor = rng.choice(doctores)
+        medicamento = rng.choice(medicamentos)
+        return {
+            "fecha": datetime(2025, rng.randint(1, 12), rng.randint(1, 28), tzinfo=timezone.utc).isoformat(),
+            "cliente": cliente,
+            "doctor": {"_id": doctor["_id"], "nombre": f"{doctor['nombre']} {doctor['apellido']}",
+                       "especialidad": doctor["especialidad"]},
+            "receta": [{"medicamento_id": medicamento["_id"], "medicamento_nombre": medicamento["nombre"],
+                        "dosis": "1 tableta cada 8 horas", "duracion": "7 días"}],
+        }
+
+    makers = {"transacciones": transaccion, "citas": cita}
+
+    # Misma mezcla de documentos por las dos vías: uno por petición o
+    # bulk_size por petición; la comparación se hace en docs/s
+    def insercion_individual(rng):
+        collection = rng.choice(INSERT_COLLECTIONS)
+        return "POST", f"/{collection}", makers[collection](rng)
+
+    def insercion_masiva(rng):
+        collection = rng.choice(INSERT_COLLECTIONS)
+        return "POST", f"/{collection}/bulk", [makers[collection](rng) for _ in range(bulk_size)]
+
+    families = {"list": listado, "get_by_id": por_id, "create": alta, "stats": stats}
+    if clientes and doctores and empleados and medicamentos:
+        families["insert_single"] = insercion_individual
+        families["insert_bulk"] = insercion_masiva
+    return families
+
+
+async def run_endpoints(db, port, proc, args):
+    results = {}
+    peak_rss = rss_mb(proc.pid)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30) as client:
+        for family, make_request in request_families(db, args.bulk_size).items():
+            # Calentamiento corto para no medir el arranque del pool/caché
+            await drive(client, make_request, args.concurrency, min(1.0, args.duration))
+            results[family] = await drive(client, make_request, args.concurrency, args.duration)
+            rss = rss_mb(proc.pid)
+            results[family]["server_rss_mb"] = round(rss, 1) if rss is not None else None
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+            print(f"    {family:>13}: {results[family]['rps']:>9,.0f} req/s  "
+                  f"{results[family]['docs_per_s']:>9,.0f} docs/s  "
+                  f"p50 {results[family]['p50_ms']:.2f} ms  p99 {results[family]['p99_ms']:.2f} ms  "
+                  f"errores {results[family]['errors']}", flush=True)
+    single = results.get("insert_single", {}).get("docs_per_s")
+    if single and "insert_bulk" in results:
+        results["insert_bulk"]["speedup_vs_single"] = round(results["insert_bulk"]["docs_per_s"] / single, 1)
+        print(f"    bulk/individual: {results['insert_bulk']['speedup_vs_single']:.1f}x docs/s", flush=True)
+    return results, round(peak_rss, 1) if peak_rss is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de la API y de la ingesta de Pharmacien")
+    parser.add_argument("--scales", default="1,10", help="Escalas del generador separadas por comas")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0, help="Segundos por familia de endpoints")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Workers de generación/ingesta")
+    parser.add_argument("--api-workers", type=int, default=1, help="Workers de uvicorn")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--bulk-size", type=int, default=1000, help="Documentos por petición en insert_bulk")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--db-name", default="pharmacien_bench", help="Base de datos de pruebas (se borra)")
+    parser.add_argument("--keep", action="store_true", help="No borrar la base de datos al terminar")
+    parser.add_argument("--output", default=None, help="Archivo JSON de resultados")
+    args = parser.parse_args()
+
+    # Los workers de ingesta son otros procesos: heredan el módulo (fork) o
+    # lo vuelven a importar y leen DB_NAME del entorno (spawn/forkserver)
+    os.environ["DB_NAME"] = args.db_name
+    ingest_dataset.DB_NAME = args.db_name
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "keep")},
+        "runs": [],
+    }
+
+    for scale in [float(s) for s in args.scales.split(",") if s.strip()]:
+        print(f"\n▶ escala {scale:g}")
+        db, ingest = seed_database(args.db_name, scale, args.seed, args.workers, args.batch_size)
+        print(f"    ingesta: {ingest['counts']['total']:,} docs en {ingest['ingest_seconds']:.1f}s "
+              f"({ingest['ingest_docs_per_s']:,.0f} docs/s)", flush=True)
+        proc = start_server(args.db_name, args.port, args.api_workers)
+        try:
+            endpoints, peak_rss = asyncio.run(run_endpoints(db, args.port, proc, args))
+        finally:
+            stop_server(proc)
+        report["runs"].append({"scale": scale, "ingest": ingest, "endpoints": endpoints, "server_peak_rss_mb": peak_rss})
+
+    if not args.keep:
+        MongoClient(MONGO_URI).drop_database(args.db_name)
+
+    output = args.output or os.path.join(SCRIPTS_DIR, "data", "bench",
+                                         f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nResultados en {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,33 @@
 #!/usr/bin/env python3
 # scripts/cleanup_collections.py
+# Vacía las colecciones intercambiándolas por una colección vacía (con sus
+# índices) en vez de delete_many: no borra documento a documento ni genera
+# oplog por cada uno, y la API nunca ve una colección a medio vaciar.
 from pymongo import MongoClient
 import os
 from dotenv import load_dotenv
+from rollups import ROLLUP_COLLECTIONS
+from staging import create_staging, swap_in
 
 load_dotenv()
-client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017"))
-db = client[os.getenv("DB_NAME", "rag_pharmacien")]
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
 
-cols = ["farmacias", "medicamentos", "clientes", "proveedores", "doctores", "citas", "transacciones"]
+cols = ["farmacias", "medicamentos", "clientes", "proveedores", "doctores", "citas", "transacciones", "inventario", "propagaciones"]
 
-for c in cols:
-    res = db[c].delete_many({})
-    print(f"Cleared {c}: {res.deleted_count} docs")
 
-print("All collections cleaned successfully!")
+def cleanup(db, collections=None):
+    cleared = {}
+    for c in collections or cols + ROLLUP_COLLECTIONS:
+        cleared[c] = db[c].estimated_document_count()
+        create_staging(db, c)
+        swap_in(db, c)
+    return cleared
+
+
+if __name__ == "__main__":
+    db = MongoClient(MONGO_URI)[DB_NAME]
+    for c, n in cleanup(db).items():
+        print(f"Cleared {c}: {n} docs")
+
+    print("All collections cleaned successfully!")
@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
 # scripts/create_indexes_and_validators.py
-from pymongo import MongoClient, TEXT, ASCENDING
+# Crea validadores e índices; con --check verifica con explain que los
+# patrones de consulta de la API usan índice (falla si alguno hace COLLSCAN).
+import argparse
 import os
+import sys
+from datetime import datetime
+from pymongo import MongoClient, TEXT, ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
 from dotenv import load_dotenv
 
 load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI","mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME","rag_pharmacien")
 
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-
 # Validator
 validator = {
   "$jsonSchema": {
@@ -26,13 +29,187 @@ validator = {
   }
 }
 
-try:
-    db.create_collection("documents", validator=validator)
-except Exception as e:
-    print("documents collection exists or validator may already be set:", e)
+# Índices por colección. Los compuestos terminan en el orden de paginación
+# de la API ((fecha, _id) o _id) para que filtro + cursor usen el mismo índice.
+INDEX_SPECS = {
+    "documents": [
+        IndexModel([("title", TEXT), ("content", TEXT)], name="textIdx_docs"),
+        IndexModel([("related_medicamento", ASCENDING)]),
+    ],
+    "images": [
+        IndexModel([("related_med_id", ASCENDING)]),
+    ],
+    "citas": [
+        IndexModel([("fecha", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("cliente._id", ASCENDING), ("fecha", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("doctor._id", ASCENDING), ("fecha", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("receta.medicamento_id", ASCENDING)]),
+    ],
+    "transacciones": [
+        IndexModel([("fecha", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("citaref", ASCENDING), ("fecha", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("metodopago", ASCENDING), ("fecha", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("empleado._id", ASCENDING), ("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ],
+    "medicamentos": [
+        IndexModel([("nombre", ASCENDING)]),
+        IndexModel([("nombre", TEXT), ("categoria.nombre", TEXT)], name="textIdx_medicamentos",
+                   default_language="spanish", weights={"nombre": 10}),
+        IndexModel([("busqueda", ASCENDING)]),
+        IndexModel([("categoria.nombre", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("proveedores", ASCENDING), ("_id", ASCENDING)]),
+    ],
+    # /search: texto completo (stemming en español, sin distinguir acentos) y
+    # prefijos sobre el campo normalizado `busqueda` (ver search_fields.py)
+    "clientes": [
+        IndexModel([("nombre", TEXT)], name="textIdx_clientes", default_language="spanish"),
+        IndexModel([("busqueda", ASCENDING)]),
+    ],
+    "doctores": [
+        IndexModel([("nombre", TEXT), ("apellido", TEXT), ("especialidad", TEXT)], name="textIdx_doctores",
+                   default_language="spanish", weights={"nombre": 10, "apellido": 10}),
+        IndexModel([("busqueda", ASCENDING)]),
+    ],
+    "farmacias": [
+        IndexModel([("ciudad", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("empleados._id", ASCENDING)]),
+    ],
+    "inventario": [
+        IndexModel([("farmacia_id", ASCENDING), ("medicamento_id", ASCENDING)], unique=True),
+        IndexModel([("farmacia_id", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("medicamento_id", ASCENDING), ("stock", ASCENDING)]),
+    ],
+    # Trabajos de propagación de copias embebidas (PATCH de la API)
+    "propagaciones": [
+        IndexModel([("estado", ASCENDING), ("creado", ASCENDING)]),
+        IndexModel([("tipo", ASCENDING), ("entidad_id", ASCENDING), ("estado", ASCENDING)]),
+    ],
+    # Rollups de scripts/rollups.py: lecturas por ventana de días
+    "rollup_ventas_metodo": [IndexModel([("_id.dia", ASCENDING)])],
+    "rollup_ventas_empleado": [IndexModel([("_id.dia", ASCENDING)])],
+    "rollup_prescripciones": [IndexModel([("_id.dia", ASCENDING)])],
+}
+
+# Patrones de consulta conocidos: (colección, filtro, orden)
+RANGO_FECHAS = {"$gte": datetime(2024, 1, 1), "$lt": datetime(2024, 2, 1)}
+QUERY_PATTERNS = [
+    ("citas", {}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("citas", {"fecha": RANGO_FECHAS}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("citas", {"cliente._id": "x"}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("citas", {"doctor._id": "x"}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("citas", {"doctor._id": "x", "fecha": RANGO_FECHAS}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("citas", {"cliente._id": "x", "fecha": RANGO_FECHAS}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("transacciones", {}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("transacciones", {"fecha": RANGO_FECHAS}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("transacciones", {"citaref": "x"}, None),
+    ("transacciones", {"citaref": "x"}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("transacciones", {"metodopago": "Efectivo"}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("transacciones", {"metodopago": "Efectivo", "fecha": RANGO_FECHAS}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("transacciones", {"empleado._id": "x"}, [("fecha", ASCENDING), ("_id", ASCENDING)]),
+    ("medicamentos", {"categoria.nombre": "Analgésicos"}, [("_id", ASCENDING)]),
+    ("medicamentos", {"proveedores": "x"}, [("_id", ASCENDING)]),
+    ("medicamentos", {"nombre": {"$in": ["Paracetamol", "Ibuprofeno"]}}, None),
+    ("medicamentos", {"busqueda": {"$regex": "^para"}}, None),
+    ("medicamentos", {"$text": {"$search": "paracetamol"}}, None),
+    ("clientes", {"busqueda": {"$regex": "^maria"}}, None),
+    ("clientes", {"$text": {"$search": "maria"}}, None),
+    ("doctores", {"busqueda": {"$regex": "^perez"}}, None),
+    ("doctores", {"$text": {"$search": "cardiologia"}}, None),
+    ("farmacias", {"ciudad": "Puebla"}, [("_id", ASCENDING)]),
+    ("inventario", {"medicamento_id": "y"}, None),
+    ("inventario", {"farmacia_id": {"$in": ["x", "z"]}}, [("farmacia_id", ASCENDING), ("_id", ASCENDING)]),
+    ("citas", {"receta": {"$elemMatch": {"medicamento_id": "x", "$or": [{"medicamento_nombre": {"$ne": "y"}}]}}}, None),
+    ("transacciones", {"empleado": {"$elemMatch": {"_id": "x", "$or": [{"nombre": {"$ne": "y"}}]}}}, None),
+    ("farmacias", {"empleados._id": "x"}, None),
+    ("propagaciones", {"estado": "pendiente"}, [("creado", ASCENDING)]),
+    ("inventario", {"farmacia_id": "x"}, [("_id", ASCENDING)]),
+    ("inventario", {"farmacia_id": "x", "stock": {"$gt": 0}}, [("_id", ASCENDING)]),
+    ("inventario", {"farmacia_id": "x", "medicamento_id": "y", "stock": {"$gte": 1}}, None),
+    ("inventario", {"medicamento_id": "y", "stock": {"$gt": 0}}, None),
+]
+
+
+# Índices que ya no se usan y se eliminan donde existan
+RETIRED_INDEXES = {
+    # farmacias.medicamentos: las consultas por medicamento van a inventario
+    "farmacias": [[("medicamentos", ASCENDING), ("_id", ASCENDING)]],
+}
+
+
+def apply_indexes(db, collection, target=None):
+    # create_indexes es idempotente con la misma especificación; si ya existe
+    # un índice con las mismas claves y otras opciones/nombre se reemplaza.
+    coll = db[target or collection]
+    retired = RETIRED_INDEXES.get(collection, [])
+    if retired:
+        for name, info in coll.index_information().items():
+            if list(info["key"]) in retired:
+                coll.drop_index(name)
+    for model in INDEX_SPECS.get(collection, []):
+        try:
+            coll.create_indexes([model])
+        except OperationFailure as e:
+            if e.code not in (85, 86):  # IndexOptionsConflict, IndexKeySpecsConflict
+                raise
+            spec = model.document
+            for name, info in coll.index_information().items():
+                if name == spec["name"] or list(info["key"]) == list(spec["key"].items()):
+                    coll.drop_index(name)
+            coll.create_indexes([model])
+
+
+def create_validators(db):
+    try:
+        db.create_collection("documents", validator=validator)
+    except Exception as e:
+        print("documents collection exists or validator may already be set:", e)
+
+
+def _stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+def check_query_plans(db):
+    failures = []
+    for collection, query, sort in QUERY_PATTERNS:
+        cmd = {"find": collection, "filter": query}
+        if sort:
+            cmd["sort"] = dict(sort)
+        plan = db.command("explain", cmd, verbosity="queryPlanner")["queryPlanner"]["winningPlan"]
+        stages = set(_stages(plan))
+        status = "COLLSCAN" if "COLLSCAN" in stages else "ok"
+        print(f"  {status:>8}  {collection} {query} sort={sort}")
+        if "COLLSCAN" in stages:
+            failures.append((collection, query))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validadores e índices de Pharmacien")
+    parser.add_argument("--check", action="store_true", help="Verificar con explain que ningún patrón hace COLLSCAN")
+    args = parser.parse_args()
+
+    db = MongoClient(MONGO_URI)[DB_NAME]
+    create_validators(db)
+    for collection in INDEX_SPECS:
+        apply_indexes(db, collection)
+    print("Indexes created.")
+
+    if args.check:
+        print("Verificando planes de consulta...")
+        failures = check_query_plans(db)
+        if failures:
+            print(f"❌ {len(failures)} patrón(es) de consulta sin índice")
+            sys.exit(1)
+        print("✅ Todos los patrones de consulta usan índice")
+
 
-# Indexes
-db.documents.create_index([("title", TEXT), ("content", TEXT)], name="textIdx_docs")
-db.documents.create_index([("related_medicamento", ASCENDING)])
-db.images.create_index([("related_med_id", ASCENDING)])
-print("Indexes created.")
+if __name__ == "__main__":
+    main()
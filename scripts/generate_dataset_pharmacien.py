@@ -1,21 +1,38 @@
 #!/usr/bin/env python3
 # scripts/generate_dataset_pharmacien.py
-# Genera un dataset JSON con datos para las 7 colecciones
+# Genera un dataset con datos para las 7 colecciones.
+# Cada documento es función pura de (seed, colección, índice), así los
+# workers generan rangos de índices en paralelo, las referencias entre
+# colecciones (cita -> cliente/doctor/medicamento, transacción -> cita)
+# siguen siendo válidas y la memoria no crece con el volumen.
+import argparse
 import json
+import multiprocessing
+import os
 import random
+import shutil
+import tempfile
+import time
 import uuid
-import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 
-def random_date(start_year=2023, end_year=2025):
-    start = datetime(start_year, 1, 1)
-    end = datetime(end_year, 12, 31)
-    delta = end - start
-    return start + timedelta(days=random.randint(0, delta.days))
+COLLECTIONS = ["proveedores", "medicamentos", "farmacias", "clientes", "doctores", "citas", "transacciones"]
 
-def random_phone():
-    return f"+52-{random.randint(100,999)}-{random.randint(100,999)}-{random.randint(1000,9999)}"
+# Volúmenes por defecto (los del dataset original); empleados no es una
+# colección, se embeben en farmacias y transacciones.
+DEFAULT_COUNTS = {
+    "proveedores": 20,
+    "medicamentos": 50,
+    "empleados": 30,
+    "farmacias": 10,
+    "clientes": 40,
+    "doctores": 25,
+    "citas": 60,
+    "transacciones": 80,
+}
 
+WRITE_BATCH = 10000
 
 # Ciudades
 ciudades = ["Ciudad de México", "Guadalajara", "Monterrey", "Puebla", "Tijuana", "León", "Querétaro"]
@@ -42,8 +59,6 @@ especialidades = [
 # Métodos de pago
 metodos_pago = ["Efectivo", "Tarjeta de Crédito", "Tarjeta de Débito", "Transferencia", "Cheque"]
 
-# 1. Generar Proveedores (20)
-proveedores = []
 nombres_proveedores = [
     "Farmacéutica Nacional", "Laboratorios del Valle", "MediSupply SA",
     "Distribuidora Salud", "Pharma Express", "Medicamentos del Norte",
@@ -54,18 +69,6 @@ nombres_proveedores = [
     "Laboratorios Especializados", "Medicamentos Integrales"
 ]
 
-for i, nombre in enumerate(nombres_proveedores):
-    prov_id = str(uuid.uuid4())
-    proveedores.append({
-        "_id": prov_id,
-        "nombre": nombre,
-        "telefono": random_phone(),
-        "direccion": f"Av. Industrial {random.randint(100, 9999)}",
-        "ciudad": random.choice(ciudades)
-    })
-
-# 2. Generar Medicamentos (50)
-medicamentos = []
 nombres_medicamentos = [
     "Paracetamol", "Ibuprofeno", "Amoxicilina", "Aspirina", "Omeprazol",
     "Loratadina", "Metformina", "Atorvastatina", "Losartán", "Diclofenaco",
@@ -79,97 +82,121 @@ nombres_medicamentos = [
     "Warfarina", "Clopidogrel", "Simvastatina", "Amlodipino", "Carvedilol"
 ]
 
-for i, nombre in enumerate(nombres_medicamentos):
-    med_id = str(uuid.uuid4())
-    categoria = random.choice(categorias)
-    num_proveedores = random.randint(1, 3)
-    provs_refs = random.sample([p["_id"] for p in proveedores], num_proveedores)
-    
-    medicamentos.append({
-        "_id": med_id,
-        "nombre": nombre,
-        "precio": round(random.uniform(50.0, 1500.0), 2),
-        "categoria": categoria,
-        "proveedores": provs_refs
-    })
-
-# 3. Generar Empleados (30) - serán embebidos en farmacias
-empleados_pool = []
 nombres = ["Juan", "María", "Carlos", "Ana", "Luis", "Carmen", "José", "Laura", "Miguel", "Patricia"]
 apellidos = ["García", "Rodríguez", "Martínez", "López", "González", "Pérez", "Sánchez", "Ramírez", "Torres", "Flores"]
 
-for i in range(30):
-    empleados_pool.append({
-        "_id": str(uuid.uuid4()),
-        "nombre": f"{random.choice(nombres)} {random.choice(apellidos)}",
-        "puesto": random.choice(["Farmacéutico", "Auxiliar", "Cajero", "Gerente"]),
-        "telefono": random_phone()
-    })
-
-# 4. Generar Farmacias (10)
-farmacias = []
-for i in range(1, 11):
-    farm_id = str(uuid.uuid4())
-    num_empleados = random.randint(2, 5)
-    empleados_farmacia = random.sample(empleados_pool, num_empleados)
-    
-    num_medicamentos = random.randint(10, 25)
-    meds_farmacia = random.sample([m["nombre"] for m in medicamentos], num_medicamentos)
-    
-    farmacias.append({
+
+def rng_for(seed, collection, i):
+    return random.Random(f"{seed}:{collection}:{i}")
+
+def make_id(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def id_for(seed, collection, i):
+    return make_id(rng_for(seed, collection, i))
+
+def random_date(rng, start_year=2023, end_year=2025):
+    start = datetime(start_year, 1, 1)
+    end = datetime(end_year, 12, 31)
+    delta = end - start
+    return start + timedelta(days=rng.randint(0, delta.days))
+
+def random_phone(rng):
+    return f"+52-{rng.randint(100,999)}-{rng.randint(100,999)}-{rng.randint(1000,9999)}"
+
+def nombre_indexado(nombres, i):
+    # Por encima del catálogo base los nombres se numeran: "Paracetamol 2"
+    base = nombres[i % len(nombres)]
+    return base if i < len(nombres) else f"{base} {i // len(nombres) + 1}"
+
+
+def make_proveedor(seed, counts, i):
+    rng = rng_for(seed, "proveedores", i)
+    return {
+        "_id": make_id(rng),
+        "nombre": nombre_indexado(nombres_proveedores, i),
+        "telefono": random_phone(rng),
+        "direccion": f"Av. Industrial {rng.randint(100, 9999)}",
+        "ciudad": rng.choice(ciudades)
+    }
+
+def make_medicamento(seed, counts, i):
+    rng = rng_for(seed, "medicamentos", i)
+    med_id = make_id(rng)
+    num_proveedores = min(rng.randint(1, 3), counts["proveedores"])
+    return {
+        "_id": med_id,
+        "nombre": nombre_indexado(nombres_medicamentos, i),
+        "precio": round(rng.uniform(50.0, 1500.0), 2),
+        "categoria": rng.choice(categorias),
+        "proveedores": [id_for(seed, "proveedores", j)
+                        for j in rng.sample(range(counts["proveedores"]), num_proveedores)]
+    }
+
+def make_empleado(seed, counts, i):
+    rng = rng_for(seed, "empleados", i)
+    return {
+        "_id": make_id(rng),
+        "nombre": f"{rng.choice(nombres)} {rng.choice(apellidos)}",
+        "puesto": rng.choice(["Farmacéutico", "Auxiliar", "Cajero", "Gerente"]),
+        "telefono": random_phone(rng)
+    }
+
+def make_farmacia(seed, counts, i):
+    rng = rng_for(seed, "farmacias", i)
+    farm_id = make_id(rng)
+    num_empleados = min(rng.randint(2, 5), counts["empleados"])
+    num_medicamentos = min(rng.randint(10, 25), counts["medicamentos"])
+    return {
         "_id": farm_id,
-        "ciudad": random.choice(ciudades),
-        "direccion": f"Calle {random.randint(1, 100)} #{random.randint(100, 999)}",
-        "telefono": random_phone(),
-        "empleados": empleados_farmacia,
-        "medicamentos": meds_farmacia
-    })
-
-# 5. Generar Clientes (40)
-clientes = []
-for i in range(40):
-    cliente_id = str(uuid.uuid4())
-    clientes.append({
-        "_id": cliente_id,
-        "nombre": f"{random.choice(nombres)} {random.choice(apellidos)}",
-        "direccion": f"Calle {random.randint(1, 200)} #{random.randint(10, 999)}",
-        "telefono": random_phone()
-    })
-
-# 6. Generar Doctores (25)
-doctores = []
-for i in range(25):
-    doctor_id = str(uuid.uuid4())
-    doctores.append({
-        "_id": doctor_id,
-        "nombre": random.choice(nombres),
-        "apellido": random.choice(apellidos),
-        "especialidad": random.choice(especialidades),
-        "telefono": random_phone()
-    })
-
-# 7. Generar Citas (60)
-citas = []
-for i in range(60):
-    cita_id = str(uuid.uuid4())
-    cliente = random.choice(clientes)
-    doctor = random.choice(doctores)
-    
+        "ciudad": rng.choice(ciudades),
+        "direccion": f"Calle {rng.randint(1, 100)} #{rng.randint(100, 999)}",
+        "telefono": random_phone(rng),
+        "empleados": [make_empleado(seed, counts, j)
+                      for j in rng.sample(range(counts["empleados"]), num_empleados)],
+        "medicamentos": [nombre_indexado(nombres_medicamentos, j)
+                         for j in rng.sample(range(counts["medicamentos"]), num_medicamentos)]
+    }
+
+def make_cliente(seed, counts, i):
+    rng = rng_for(seed, "clientes", i)
+    return {
+        "_id": make_id(rng),
+        "nombre": f"{rng.choice(nombres)} {rng.choice(apellidos)}",
+        "direccion": f"Calle {rng.randint(1, 200)} #{rng.randint(10, 999)}",
+        "telefono": random_phone(rng)
+    }
+
+def make_doctor(seed, counts, i):
+    rng = rng_for(seed, "doctores", i)
+    return {
+        "_id": make_id(rng),
+        "nombre": rng.choice(nombres),
+        "apellido": rng.choice(apellidos),
+        "especialidad": rng.choice(especialidades),
+        "telefono": random_phone(rng)
+    }
+
+def make_cita(seed, counts, i):
+    rng = rng_for(seed, "citas", i)
+    cita_id = make_id(rng)
+    cliente = make_cliente(seed, counts, rng.randrange(counts["clientes"]))
+    doctor = make_doctor(seed, counts, rng.randrange(counts["doctores"]))
+
     # Receta embebida
-    num_medicamentos_receta = random.randint(1, 4)
     receta = []
-    for _ in range(num_medicamentos_receta):
-        med = random.choice(medicamentos)
+    for _ in range(rng.randint(1, 4)):
+        j = rng.randrange(counts["medicamentos"])
         receta.append({
-            "medicamento_id": med["_id"],
-            "medicamento_nombre": med["nombre"],
-            "dosis": f"{random.randint(1, 3)} tableta(s) cada {random.choice([4, 6, 8, 12, 24])} horas",
-            "duracion": f"{random.randint(3, 14)} días"
+            "medicamento_id": id_for(seed, "medicamentos", j),
+            "medicamento_nombre": nombre_indexado(nombres_medicamentos, j),
+            "dosis": f"{rng.randint(1, 3)} tableta(s) cada {rng.choice([4, 6, 8, 12, 24])} horas",
+            "duracion": f"{rng.randint(3, 14)} días"
         })
-    
-    citas.append({
+
+    return {
         "_id": cita_id,
-        "fecha": random_date(2024, 2025),
+        "fecha": random_date(rng, 2024, 2025),
         "cliente": {
             "_id": cliente["_id"],
             "nombre": cliente["nombre"],
@@ -181,63 +208,165 @@ for i in range(60):
             "especialidad": doctor["especialidad"]
         },
         "receta": receta
-    })
+    }
+
+def make_transaccion(seed, counts, i):
+    rng = rng_for(seed, "transacciones", i)
+    trans_id = make_id(rng)
 
-# 8. Generar Transacciones (80)
-transacciones = []
-for i in range(80):
-    trans_id = str(uuid.uuid4())
-    
     # 70% de transacciones tienen cita asociada
-    cita_ref = random.choice(citas)["_id"] if random.random() < 0.7 else None
-    
+    cita_ref = None
+    if counts["citas"] and rng.random() < 0.7:
+        cita_ref = id_for(seed, "citas", rng.randrange(counts["citas"]))
+
     # Empleado embebido
-    empleado = random.choice(empleados_pool)
-    empleado_embed = [{
-        "_id": empleado["_id"],
-        "nombre": empleado["nombre"],
-        "puesto": empleado["puesto"]
-    }]
-    
-    transacciones.append({
+    empleado = make_empleado(seed, counts, rng.randrange(counts["empleados"]))
+    return {
         "_id": trans_id,
-        "fecha": random_date(2024, 2025),
-        "totalpagado": round(random.uniform(100.0, 5000.0), 2),
-        "metodopago": random.choice(metodos_pago),
-        "empleado": empleado_embed,
+        "fecha": random_date(rng, 2024, 2025),
+        "totalpagado": round(rng.uniform(100.0, 5000.0), 2),
+        "metodopago": rng.choice(metodos_pago),
+        "empleado": [{
+            "_id": empleado["_id"],
+            "nombre": empleado["nombre"],
+            "puesto": empleado["puesto"]
+        }],
         "citaref": cita_ref
-    })
-
-# Crear dataset completo
-dataset = {
-    "generated_at": datetime.utcnow().isoformat(),
-    "counts": {
-        "proveedores": len(proveedores),
-        "medicamentos": len(medicamentos),
-        "farmacias": len(farmacias),
-        "clientes": len(clientes),
-        "doctores": len(doctores),
-        "citas": len(citas),
-        "transacciones": len(transacciones),
-        "total": len(proveedores) + len(medicamentos) + len(farmacias) + len(clientes) + len(doctores) + len(citas) + len(transacciones)
-    },
-    "proveedores": proveedores,
-    "medicamentos": medicamentos,
-    "farmacias": farmacias,
-    "clientes": clientes,
-    "doctores": doctores,
-    "citas": citas,
-    "transacciones": transacciones
+    }
+
+MAKERS = {
+    "proveedores": make_proveedor,
+    "medicamentos": make_medicamento,
+    "farmacias": make_farmacia,
+    "clientes": make_cliente,
+    "doctores": make_doctor,
+    "citas": make_cita,
+    "transacciones": make_transaccion,
 }
 
-# Guardar dataset
-os.makedirs("data", exist_ok=True)
-with open("data/pharmacien_rag_dataset.json", "w", encoding="utf-8") as f:
-    json.dump(dataset, f, ensure_ascii=False, indent=2, default=str)
-
-print(f"Dataset generado: data/pharmacien_rag_dataset.json")
-print(f"Total de documentos: {dataset['counts']['total']}")
-print(f"Desglose:")
-for key, value in dataset['counts'].items():
-    if key != 'total':
-        print(f"  - {key}: {value}")
+
+def iter_docs(seed, counts, collection, start, end):
+    make = MAKERS[collection]
+    for i in range(start, end):
+        yield make(seed, counts, i)
+
+def write_shard(task):
+    # Un worker escribe un rango [start, end) de una colección como NDJSON
+    seed, counts, collection, start, end, path = task
+    lines = []
+    with open(path, "w", encoding="utf-8") as f:
+        for doc in iter_docs(seed, counts, collection, start, end):
+            lines.append(json.dumps(doc, ensure_ascii=False, default=str) + "\n")
+            if len(lines) >= WRITE_BATCH:
+                f.writelines(lines)
+                lines = []
+        f.writelines(lines)
+    return collection, end - start
+
+def shard_tasks(seed, counts, tmpdir, shard_size):
+    tasks = {c: [] for c in COLLECTIONS}
+    for collection in COLLECTIONS:
+        for start in range(0, counts[collection], shard_size):
+            end = min(start + shard_size, counts[collection])
+            path = os.path.join(tmpdir, f"{collection}.{start:012d}.ndjson")
+            tasks[collection].append((seed, counts, collection, start, end, path))
+    return tasks
+
+
+def write_ndjson(out_dir, tasks, manifest):
+    os.makedirs(out_dir, exist_ok=True)
+    for collection in COLLECTIONS:
+        with open(os.path.join(out_dir, f"{collection}.ndjson"), "wb") as out:
+            for task in tasks[collection]:
+                with open(task[-1], "rb") as part:
+                    shutil.copyfileobj(part, out)
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+def write_json(out_path, tasks, manifest):
+    # Mismo formato que el dataset original, escrito en streaming a partir de
+    # los fragmentos NDJSON (un documento por línea dentro de cada arreglo).
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as out:
+        out.write("{\n")
+        out.write(f'  "generated_at": {json.dumps(manifest["generated_at"])},\n')
+        out.write(f'  "seed": {json.dumps(manifest["seed"])},\n')
+        out.write(f'  "counts": {json.dumps(manifest["counts"], ensure_ascii=False)}')
+        for collection in COLLECTIONS:
+            out.write(f',\n  "{collection}": [')
+            first = True
+            for task in tasks[collection]:
+                with open(task[-1], "r", encoding="utf-8") as part:
+                    for line in part:
+                        out.write("\n    " if first else ",\n    ")
+                        out.write(line.rstrip("\n"))
+                        first = False
+            out.write("\n  ]")
+        out.write("\n}\n")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generador del dataset Pharmacien")
+    for name, default in DEFAULT_COUNTS.items():
+        parser.add_argument(f"--{name}", type=int, default=default, help=f"Número de {name} (defecto {default})")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplica todos los volúmenes")
+    parser.add_argument("--seed", type=int, default=None, help="Semilla para ejecuciones reproducibles")
+    parser.add_argument("--format", choices=["json", "ndjson"], default="json",
+                        help="json: un archivo como el dataset original; ndjson: un archivo por colección")
+    parser.add_argument("--out", default=None,
+                        help="Ruta de salida (defecto data/pharmacien_rag_dataset.json o data/ndjson)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shard-size", type=int, default=25000, help="Documentos por fragmento de trabajo")
+    return parser.parse_args()
+
+def generate(counts, seed, fmt="json", out=None, workers=1, shard_size=25000):
+    out = out or ("data/pharmacien_rag_dataset.json" if fmt == "json" else "data/ndjson")
+    manifest = {
+        "generated_at": datetime.utcnow().isoformat(),
+        "seed": seed,
+        "counts": {c: counts[c] for c in COLLECTIONS},
+    }
+    manifest["counts"]["total"] = sum(counts[c] for c in COLLECTIONS)
+
+    # Los fragmentos se escriben junto a la salida (mismo disco) y se borran al final
+    parent = os.path.dirname(os.path.abspath(out))
+    os.makedirs(parent, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(prefix="pharmacien_", dir=parent) as tmpdir:
+        tasks = shard_tasks(seed, counts, tmpdir, shard_size)
+        all_tasks = [t for c in COLLECTIONS for t in tasks[c]]
+        if workers > 1 and len(all_tasks) > 1:
+            # spawn: run_all llama aquí desde un hilo mientras otro usa
+            # pymongo; hacer fork de un proceso con hilos puede bloquearse
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                for _ in pool.map(write_shard, all_tasks):
+                    pass
+        else:
+            for task in all_tasks:
+                write_shard(task)
+        if fmt == "ndjson":
+            write_ndjson(out, tasks, manifest)
+        else:
+            write_json(out, tasks, manifest)
+    return out, manifest
+
+def main():
+    args = parse_args()
+    seed = args.seed if args.seed is not None else random.randrange(2**32)
+    counts = {name: max(1, int(getattr(args, name) * args.scale)) for name in DEFAULT_COUNTS}
+
+    t0 = time.perf_counter()
+    out, manifest = generate(counts, seed, args.format, args.out, args.workers, args.shard_size)
+    elapsed = time.perf_counter() - t0
+
+    total = manifest["counts"]["total"]
+    print(f"Dataset generado: {out}")
+    print(f"Semilla: {seed}")
+    print(f"Total de documentos: {total} ({elapsed:.1f}s, {total / elapsed:,.0f} docs/s)")
+    print(f"Desglose:")
+    for key, value in manifest["counts"].items():
+        if key != 'total':
+            print(f"  - {key}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,287 @@
 #!/usr/bin/env python3
 # scripts/ingest_dataset.py
-# Carga pharmacien_rag_dataset.json en MongoDB
+# Carga el dataset en MongoDB en streaming:
+# - NDJSON (directorio con <colección>.ndjson): cada archivo se parte en rangos
+#   de bytes que un pool de procesos carga en paralelo.
+# - JSON (pharmacien_rag_dataset.json): se lee de forma incremental, sin
+#   json.load del archivo completo, e inserta los lotes con un pool de hilos.
+# Las fechas se convierten al parsear y los lotes se insertan desordenados.
+# Por defecto (--mode swap) se carga en colecciones de staging que se
+# intercambian con las vivas al terminar; --mode append inserta directamente.
+import argparse
 import json
+import multiprocessing
 import os
-from pymongo import MongoClient
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 from dotenv import load_dotenv
+from rollups import apply_increments, ROLLUP_SOURCES
+from search_fields import add_search_fields
+from staging import STAGING_SUFFIX, create_staging, drop_staging, swap_in
 
 load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
 
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-
-with open("data/pharmacien_rag_dataset.json", "r", encoding="utf-8") as f:
-    ds = json.load(f)
-
-# Convert date strings back to datetime objects for citas and transacciones
-for cita in ds.get("citas", []):
-    if isinstance(cita["fecha"], str):
-        cita["fecha"] = datetime.fromisoformat(cita["fecha"])
-
-for trans in ds.get("transacciones", []):
-    if isinstance(trans["fecha"], str):
-        trans["fecha"] = datetime.fromisoformat(trans["fecha"])
-
-# Insert data into collections
-collections_data = {
-    "proveedores": ds.get("proveedores", []),
-    "medicamentos": ds.get("medicamentos", []),
-    "farmacias": ds.get("farmacias", []),
-    "clientes": ds.get("clientes", []),
-    "doctores": ds.get("doctores", []),
-    "citas": ds.get("citas", []),
-    "transacciones": ds.get("transacciones", [])
-}
-
-print("Inserting data into MongoDB...")
-for col_name, data in collections_data.items():
-    if data:
-        db[col_name].delete_many({})  # Clear existing data
-        db[col_name].insert_many(data)
-        print(f"  ✓ {col_name}: {len(data)} documentos insertados")
-
-print("\n¡Ingesta completa!")
-print(f"Total de documentos insertados: {sum(len(data) for data in collections_data.values())}")
+COLLECTIONS = ["proveedores", "medicamentos", "farmacias", "clientes", "doctores", "citas", "transacciones"]
+DEFAULT_INPUT = "data/pharmacien_rag_dataset.json"
+
+
+def convert_dates(obj):
+    # object_hook: convierte "fecha" a datetime mientras se parsea
+    fecha = obj.get("fecha")
+    if isinstance(fecha, str):
+        obj["fecha"] = datetime.fromisoformat(fecha)
+    return obj
+
+decoder = json.JSONDecoder(object_hook=convert_dates)
+
+
+def iter_ndjson_range(path, start, end):
+    # Las líneas que empiezan dentro de [start, end) pertenecen a este rango
+    with open(path, "rb") as f:
+        if start:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                yield decoder.decode(line.decode("utf-8"))
+
+
+def iter_json_collections(path, chunk_size=1 << 20):
+    # Lector incremental del JSON original: recorre el objeto raíz y emite
+    # (colección, documento) elemento a elemento de cada arreglo.
+    with open(path, "r", encoding="utf-8") as f:
+        buf = ""
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        def peek():
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n":
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return buf[pos] if pos < len(buf) else ""
+                fill()
+
+        def value():
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                    # Un número al final del buffer podría estar incompleto
+                    if end < len(buf) or eof:
+                        pos = end
+                        return obj
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        def expect(char):
+            nonlocal pos
+            if peek() != char:
+                raise ValueError(f"JSON inválido en {path}: se esperaba '{char}'")
+            pos += 1
+
+        expect("{")
+        while peek() != "}":
+            key = value()
+            expect(":")
+            if key in COLLECTIONS and peek() == "[":
+                expect("[")
+                while peek() != "]":
+                    yield key, value()
+                    if peek() == ",":
+                        expect(",")
+                expect("]")
+            else:
+                value()
+            if peek() == ",":
+                expect(",")
+
+
+def insert_batch(db, collection, docs, suffix=""):
+    add_search_fields(collection, docs)
+    try:
+        db[collection + suffix].insert_many(docs, ordered=False)
+        failed = set()
+    except BulkWriteError as e:
+        failed = {err["index"] for err in e.details.get("writeErrors", [])}
+    # Los rollups solo suman los documentos realmente insertados
+    apply_increments(db, collection, [d for i, d in enumerate(docs) if i not in failed] if failed else docs, suffix)
+    return len(docs) - len(failed), len(failed)
+
+
+_client = None
+
+def load_range(task):
+    # Worker de proceso: un cliente por proceso, reutilizado entre tareas
+    global _client
+    collection, path, start, end, batch_size, suffix = task
+    if _client is None:
+        _client = MongoClient(MONGO_URI)
+    db = _client[DB_NAME]
+    t0 = time.perf_counter()
+    inserted = errors = 0
+    batch = []
+    for doc in iter_ndjson_range(path, start, end):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            n, e = insert_batch(db, collection, batch, suffix)
+            inserted, errors, batch = inserted + n, errors + e, []
+    if batch:
+        n, e = insert_batch(db, collection, batch, suffix)
+        inserted, errors = inserted + n, errors + e
+    return collection, inserted, errors, time.perf_counter() - t0
+
+
+def ndjson_tasks(input_dir, chunk_bytes, batch_size, suffix):
+    tasks = []
+    for collection in COLLECTIONS:
+        path = os.path.join(input_dir, f"{collection}.ndjson")
+        if not os.path.exists(path):
+            continue
+        size = os.path.getsize(path)
+        for start in range(0, size, chunk_bytes):
+            tasks.append((collection, path, start, min(start + chunk_bytes, size), batch_size, suffix))
+    return tasks
+
+
+class Progress:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.inserted = dict.fromkeys(COLLECTIONS, 0)
+        self.errors = dict.fromkeys(COLLECTIONS, 0)
+
+    def add(self, collection, inserted, errors):
+        self.inserted[collection] += inserted
+        self.errors[collection] += errors
+        total = sum(self.inserted.values())
+        elapsed = time.perf_counter() - self.t0
+        print(f"  … {collection}: {self.inserted[collection]:,} docs | total {total:,} "
+              f"({total / elapsed if elapsed else 0:,.0f} docs/s)", flush=True)
+
+
+def task_key(task):
+    collection, _, start, _, _, _ = task
+    return f"{collection}:{start}"
+
+def ingest_ndjson(input_dir, workers, batch_size, chunk_bytes, suffix, progress,
+                  done_tasks=(), on_task_done=None):
+    # done_tasks/on_task_done permiten reanudar una carga interrumpida
+    # saltando los rangos que ya se completaron.
+    tasks = [t for t in ndjson_tasks(input_dir, chunk_bytes, batch_size, suffix) if task_key(t) not in done_tasks]
+    # spawn y no fork: el proceso padre ya tiene un MongoClient abierto (con
+    # sus hilos de monitorización); cada worker abre el suyo en load_range
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(load_range, t): t for t in tasks}
+        for future in as_completed(futures):
+            collection, inserted, errors, _ = future.result()
+            progress.add(collection, inserted, errors)
+            if on_task_done:
+                on_task_done(task_key(futures[future]), inserted)
+
+
+def ingest_json(db, path, workers, batch_size, suffix, progress):
+    # Como máximo `workers` lotes en vuelo: la memoria queda acotada
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+
+        def submit(collection, docs):
+            if len(pending) >= workers:
+                done = next(as_completed(pending))
+                pending.remove(done)
+                progress.add(*done.result())
+            future = pool.submit(lambda: (collection, *insert_batch(db, collection, docs, suffix)))
+            pending.add(future)
+
+        batch, current = [], None
+        for collection, doc in iter_json_collections(path):
+            if collection != current or len(batch) >= batch_size:
+                if batch:
+                    submit(current, batch)
+                batch, current = [], collection
+            batch.append(doc)
+        if batch:
+            submit(current, batch)
+        for future in as_completed(pending):
+            progress.add(*future.result())
+
+
+def ingest(db, input_path, workers=None, batch_size=5000, chunk_bytes=64 << 20, mode="swap",
+           resume=False, done_tasks=(), on_task_done=None):
+    workers = workers or os.cpu_count() or 1
+    suffix = STAGING_SUFFIX if mode == "swap" else ""
+    if mode == "swap":
+        # Al reanudar se conservan las colecciones de staging ya cargadas
+        existing = set(db.list_collection_names()) if resume else set()
+        for collection in COLLECTIONS + list(ROLLUP_SOURCES):
+            if collection + STAGING_SUFFIX not in existing:
+                create_staging(db, collection)
+
+    progress = Progress()
+    if os.path.isdir(input_path):
+        ingest_ndjson(input_path, workers, batch_size, chunk_bytes, suffix, progress, done_tasks, on_task_done)
+    else:
+        ingest_json(db, input_path, workers, batch_size, suffix, progress)
+
+    if mode == "swap":
+        # Como el script original, las colecciones ausentes o vacías en el
+        # dataset conservan sus datos actuales.
+        loaded = {c for c in COLLECTIONS if db[c + suffix].estimated_document_count()}
+        for collection in COLLECTIONS:
+            if collection in loaded:
+                swap_in(db, collection)
+            else:
+                drop_staging(db, collection)
+        for rollup, source in ROLLUP_SOURCES.items():
+            if source in loaded:
+                swap_in(db, rollup)
+            else:
+                drop_staging(db, rollup)
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga el dataset Pharmacien en MongoDB")
+    parser.add_argument("--input", default=DEFAULT_INPUT,
+                        help="Archivo JSON del dataset o directorio con <colección>.ndjson")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--chunk-mb", type=int, default=64, help="Tamaño de cada rango NDJSON por tarea")
+    parser.add_argument("--mode", choices=["swap", "append"], default="swap",
+                        help="swap: recarga vía staging + renameCollection; append: inserta en las colecciones vivas")
+    args = parser.parse_args()
+
+    db = MongoClient(MONGO_URI)[DB_NAME]
+    print("Inserting data into MongoDB...")
+    progress = ingest(db, args.input, args.workers, args.batch_size, args.chunk_mb << 20, args.mode)
+    elapsed = time.perf_counter() - progress.t0
+
+    for collection in COLLECTIONS:
+        errores = f" ({progress.errors[collection]} errores)" if progress.errors[collection] else ""
+        print(f"  ✓ {collection}: {progress.inserted[collection]} documentos insertados{errores}")
+    total = sum(progress.inserted.values())
+    print("\n¡Ingesta completa!")
+    print(f"Total de documentos insertados: {total} en {elapsed:.1f}s ({total / elapsed if elapsed else 0:,.0f} docs/s)")
+
+
+if __name__ == "__main__":
+    main()
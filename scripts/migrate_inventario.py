@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# scripts/migrate_inventario.py
+# Migra la lista embebida farmacias.medicamentos (nombres) a la colección
+# inventario: un documento por (farmacia_id, medicamento_id) con su stock.
+# - Por defecto hace upserts con $setOnInsert: es idempotente y no toca el
+#   stock de las entradas que ya existen.
+# - --rebuild regenera inventario desde cero en staging y la intercambia de
+#   forma atómica (tras recargar farmacias con ingest_dataset).
+# - --drop-embedded elimina después la lista embebida de las farmacias.
+import argparse
+import os
+import uuid
+from pymongo import InsertOne, MongoClient, UpdateOne
+from dotenv import load_dotenv
+from staging import STAGING_SUFFIX, bump_version, create_staging, swap_in
+
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
+
+
+def migrate(db, stock_inicial=0, rebuild=False, batch_size=5000):
+    target = "inventario" + (STAGING_SUFFIX if rebuild else "")
+    if rebuild:
+        create_staging(db, "inventario")
+    # nombre -> medicamento (el catálogo cabe en memoria)
+    catalogo = {m["nombre"]: m for m in db.medicamentos.find({}, {"nombre": 1})}
+
+    creados = sin_catalogo = 0
+    ops = []
+
+    def flush():
+        nonlocal creados, ops
+        if ops:
+            result = db[target].bulk_write(ops, ordered=False)
+            creados += result.inserted_count + result.upserted_count
+            ops = []
+
+    for farmacia in db.farmacias.find({"medicamentos.0": {"$exists": True}}, {"medicamentos": 1}):
+        for nombre in set(farmacia["medicamentos"]):
+            medicamento = catalogo.get(nombre)
+            if medicamento is None:
+                sin_catalogo += 1
+                continue
+            key = {"farmacia_id": str(farmacia["_id"]), "medicamento_id": str(medicamento["_id"])}
+            entry = {"_id": str(uuid.uuid4()), "medicamento_nombre": nombre, "stock": stock_inicial}
+            if rebuild:
+                # Staging vacía y sin índices: inserción directa, sin upserts
+                ops.append(InsertOne({**key, **entry}))
+            else:
+                ops.append(UpdateOne(key, {"$setOnInsert": entry}, upsert=True))
+            if len(ops) >= batch_size:
+                flush()
+    flush()
+
+    if rebuild:
+        swap_in(db, "inventario")
+    elif creados:
+        # ETag de /farmacias?expand=medicamentos (ver api/app.py)
+        bump_version(db, "inventario")
+    return creados, sin_catalogo
+
+
+def drop_embedded(db):
+    modificadas = db.farmacias.update_many({"medicamentos": {"$exists": True}},
+                                           {"$unset": {"medicamentos": ""}}).modified_count
+    if modificadas:
+        bump_version(db, "farmacias")
+    return modificadas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migra farmacias.medicamentos a la colección inventario")
+    parser.add_argument("--stock-inicial", type=int, default=0, help="Stock de las entradas nuevas")
+    parser.add_argument("--rebuild", action="store_true", help="Regenerar inventario desde cero (staging + swap)")
+    parser.add_argument("--drop-embedded", action="store_true", help="Eliminar farmacias.medicamentos al terminar")
+    args = parser.parse_args()
+
+    db = MongoClient(MONGO_URI)[DB_NAME]
+    creados, sin_catalogo = migrate(db, args.stock_inicial, args.rebuild)
+    print(f"  ✓ inventario: {creados} entradas nuevas ({db.inventario.estimated_document_count()} en total)")
+    if sin_catalogo:
+        print(f"  ⚠️  {sin_catalogo} nombres de medicamento sin coincidencia en el catálogo")
+    if args.drop_embedded:
+        print(f"  ✓ farmacias: lista embebida eliminada en {drop_embedded(db)} documentos")
+
+
+if __name__ == "__main__":
+    main()
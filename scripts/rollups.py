@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# scripts/rollups.py
+# Rollups materializados para los dashboards: totales diarios por método de
+# pago y por empleado, y prescripciones diarias por medicamento.
+# - apply_increments: actualización incremental con upserts $inc (ingesta/API)
+# - rebuild: regenera los rollups (o una ventana de días) con $merge
+import argparse
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pymongo import MongoClient, UpdateOne
+from dotenv import load_dotenv
+
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
+
+ROLLUP_COLLECTIONS = ["rollup_ventas_metodo", "rollup_ventas_empleado", "rollup_prescripciones"]
+
+# Colección de origen de cada rollup
+ROLLUP_SOURCES = {
+    "rollup_ventas_metodo": "transacciones",
+    "rollup_ventas_empleado": "transacciones",
+    "rollup_prescripciones": "citas",
+}
+
+
+def dia_de(fecha):
+    if isinstance(fecha, str):
+        fecha = datetime.fromisoformat(fecha)
+    if fecha.tzinfo:
+        fecha = fecha.astimezone(timezone.utc)
+    return fecha.strftime("%Y-%m-%d")
+
+
+def increments(collection, docs):
+    # Se agrupan primero en memoria: un lote de N documentos produce un
+    # upsert por clave (día, método/empleado/medicamento), no N upserts.
+    acc = defaultdict(lambda: {"inc": defaultdict(int), "set": {}})
+    if collection == "transacciones":
+        for t in docs:
+            dia = dia_de(t["fecha"])
+            total = t.get("totalpagado") or 0.0
+            entry = acc[("rollup_ventas_metodo", dia, t.get("metodopago"))]
+            entry["inc"]["total"] += total
+            entry["inc"]["transacciones"] += 1
+            for emp in t.get("empleado") or []:
+                entry = acc[("rollup_ventas_empleado", dia, emp.get("_id"))]
+                entry["inc"]["total"] += total
+                entry["inc"]["transacciones"] += 1
+                entry["set"]["nombre"] = emp.get("nombre")
+    elif collection == "citas":
+        for c in docs:
+            dia = dia_de(c["fecha"])
+            for r in c.get("receta") or []:
+                entry = acc[("rollup_prescripciones", dia, r.get("medicamento_id"))]
+                entry["inc"]["prescripciones"] += 1
+                entry["set"]["nombre"] = r.get("medicamento_nombre")
+
+    key_field = {
+        "rollup_ventas_metodo": "metodopago",
+        "rollup_ventas_empleado": "empleado_id",
+        "rollup_prescripciones": "medicamento_id",
+    }
+    ops = defaultdict(list)
+    for (rollup, dia, key), entry in acc.items():
+        update = {"$inc": dict(entry["inc"])}
+        if entry["set"]:
+            update["$set"] = entry["set"]
+        ops[rollup].append(UpdateOne({"_id": {"dia": dia, key_field[rollup]: key}}, update, upsert=True))
+    return ops
+
+
+def apply_increments(db, collection, docs, suffix=""):
+    # suffix permite acumular en los rollups de staging durante una recarga
+    for rollup, ops in increments(collection, docs).items():
+        db[rollup + suffix].bulk_write(ops, ordered=False)
+
+
+def _merge(into):
+    return {"$merge": {"into": into, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+
+
+def pipelines(desde=None, hasta=None):
+    match = []
+    if desde or hasta:
+        rango = {}
+        if desde:
+            rango["$gte"] = desde
+        if hasta:
+            rango["$lt"] = hasta
+        match = [{"$match": {"fecha": rango}}]
+    dia = {"$dateToString": {"format": "%Y-%m-%d", "date": "$fecha"}}
+    return [
+        ("transacciones", match + [
+            {"$group": {"_id": {"dia": dia, "metodopago": "$metodopago"},
+                        "total": {"$sum": "$totalpagado"}, "transacciones": {"$sum": 1}}},
+            _merge("rollup_ventas_metodo"),
+        ]),
+        ("transacciones", match + [
+            {"$unwind": "$empleado"},
+            {"$group": {"_id": {"dia": dia, "empleado_id": "$empleado._id"},
+                        "nombre": {"$last": "$empleado.nombre"},
+                        "total": {"$sum": "$totalpagado"}, "transacciones": {"$sum": 1}}},
+            _merge("rollup_ventas_empleado"),
+        ]),
+        ("citas", match + [
+            {"$unwind": "$receta"},
+            {"$group": {"_id": {"dia": dia, "medicamento_id": "$receta.medicamento_id"},
+                        "nombre": {"$last": "$receta.medicamento_nombre"},
+                        "prescripciones": {"$sum": 1}}},
+            _merge("rollup_prescripciones"),
+        ]),
+    ]
+
+
+def rebuild(db, desde=None, hasta=None):
+    # La ventana se amplía a días completos y sus claves se borran antes del
+    # $merge para que no queden días/claves que ya no existen en el origen.
+    if desde:
+        desde = datetime.strptime(dia_de(desde), "%Y-%m-%d")
+    if hasta:
+        inicio_dia = datetime.strptime(dia_de(hasta), "%Y-%m-%d")
+        hasta = inicio_dia if inicio_dia == hasta.replace(tzinfo=None) else inicio_dia + timedelta(days=1)
+    dias = {}
+    if desde:
+        dias["$gte"] = dia_de(desde)
+    if hasta:
+        dias["$lt"] = dia_de(hasta)
+    for rollup in ROLLUP_COLLECTIONS:
+        db[rollup].delete_many({"_id.dia": dias} if dias else {})
+    for source, pipeline in pipelines(desde, hasta):
+        db[source].aggregate(pipeline, allowDiskUse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Regenera los rollups materializados con $merge")
+    parser.add_argument("--desde", type=datetime.fromisoformat, help="Inicio de la ventana (incluido), ISO 8601")
+    parser.add_argument("--hasta", type=datetime.fromisoformat, help="Fin de la ventana (excluido), ISO 8601")
+    args = parser.parse_args()
+
+    db = MongoClient(MONGO_URI)[DB_NAME]
+    rebuild(db, args.desde, args.hasta)
+    for rollup in ROLLUP_COLLECTIONS:
+        print(f"  ✓ {rollup}: {db[rollup].estimated_document_count()} documentos")
+    print("Rollups regenerados.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,185 @@
 #!/usr/bin/env python3
 # scripts/run_all.py
-# Script para ejecutar todo el proceso de setup de la base de datos
-import subprocess
-import sys
+# Script para ejecutar todo el proceso de setup de la base de datos.
+# Corre los pasos en el mismo proceso con un único MongoClient, en paralelo
+# cuando no dependen entre sí (la generación del dataset no necesita la base
+# de datos), y guarda un checkpoint para que una carga interrumpida se
+# reanude desde el último rango completado en vez de empezar de cero.
+# No hace falta limpiar antes: la ingesta reemplaza cada colección con un
+# swap atómico desde staging (ver staging.py).
+import argparse
+import json
 import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient
+from dotenv import load_dotenv
+
+import generate_dataset_pharmacien as generator
+import ingest_dataset
+import migrate_inventario
+from create_indexes_and_validators import INDEX_SPECS, apply_indexes, create_validators
+
+try:
+    import vector_index
+except ImportError:  # opcional: sin numpy no se mantiene el índice vectorial
+    vector_index = None
+
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(SCRIPTS_DIR, "data")
+STATE_PATH = os.path.join(DATA_DIR, ".run_all_state.json")
+
+
+class Checkpoint:
+    def __init__(self, path, config, fresh=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {"config": config, "steps": {}, "ingest_tasks": {}}
+        if not fresh and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                previous = json.load(f)
+            # Solo se reanuda la misma configuración (misma semilla y volúmenes)
+            if previous.get("config") == config:
+                self.state = previous
 
-def run_script(script_name, description):
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+    def done(self, step):
+        return step in self.state["steps"]
+
+    def finish(self, step, seconds, docs=None):
+        with self.lock:
+            self.state["steps"][step] = {"seconds": round(seconds, 2), "docs": docs}
+            self.save()
+
+    def task_done(self, key, inserted):
+        with self.lock:
+            self.state["ingest_tasks"][key] = inserted
+            self.save()
+
+
+def run_step(checkpoint, step, description, fn):
+    if checkpoint.done(step):
+        print(f"⏭️  {description}: ya completado, se omite")
+        return
     print(f"\n{'='*60}")
     print(f"🚀 {description}")
     print(f"{'='*60}")
-    result = subprocess.run([sys.executable, script_name], cwd=os.path.dirname(os.path.abspath(__file__)))
-    if result.returncode != 0:
-        print(f"❌ Error ejecutando {script_name}")
-        sys.exit(1)
-    print(f"✅ {description} completado")
+    t0 = time.perf_counter()
+    try:
+        docs = fn()
+    except Exception as e:
+        print(f"❌ Error en '{description}': {e}")
+        raise
+    elapsed = time.perf_counter() - t0
+    checkpoint.finish(step, elapsed, docs)
+    print(f"✅ {description} completado ({elapsed:.1f}s)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Setup completo de la base de datos Pharmacien")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplica los volúmenes por defecto del generador")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--format", choices=["json", "ndjson"], default="ndjson")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--fresh", action="store_true", help="Ignorar el checkpoint y empezar de cero")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    # La semilla se guarda en el checkpoint: al reanudar sin --seed se reutiliza
+    seed = args.seed
+    if seed is None and not args.fresh and os.path.exists(STATE_PATH):
+        with open(STATE_PATH, "r", encoding="utf-8") as f:
+            seed = json.load(f).get("config", {}).get("seed")
+    if seed is None:
+        seed = random.randrange(2**32)
+    counts = {name: max(1, int(n * args.scale)) for name, n in generator.DEFAULT_COUNTS.items()}
+    config = {"seed": seed, "counts": counts, "format": args.format}
+    checkpoint = Checkpoint(STATE_PATH, config, fresh=args.fresh)
+    output = os.path.join(DATA_DIR, "ndjson" if args.format == "ndjson" else "pharmacien_rag_dataset.json")
+
+    client = MongoClient(MONGO_URI)
+    db = client[DB_NAME]
 
-if __name__ == "__main__":
     print("🏥 Iniciando setup completo de la base de datos Pharmacien")
-    
-    # Paso 1: Limpiar colecciones
-    run_script("cleanup_collections.py", "Limpiando colecciones existentes")
-    
-    # Paso 2: Crear índices y validadores
-    run_script("create_indexes_and_validators.py", "Creando índices y validadores")
-    
-    # Paso 3: Generar dataset
-    run_script("generate_dataset_pharmacien.py", "Generando dataset de prueba")
-    
-    # Paso 4: Insertar datos
-    run_script("ingest_dataset.py", "Insertando datos en MongoDB")
-    
+    print(f"   semilla={seed} escala={args.scale} formato={args.format}")
+    if checkpoint.state["steps"] or checkpoint.state["ingest_tasks"]:
+        print(f"   reanudando desde {STATE_PATH}")
+
+    def preparar_db():
+        # Paso 1: Crear índices y validadores
+        def indexes():
+            create_validators(db)
+            for collection in INDEX_SPECS:
+                apply_indexes(db, collection)
+        run_step(checkpoint, "indexes", "Creando índices y validadores", indexes)
+
+    def generar():
+        # Paso 2: Generar dataset (no depende de la base de datos)
+        run_step(checkpoint, "generate", "Generando dataset de prueba",
+                 lambda: generator.generate(counts, seed, args.format, output, args.workers)[1]["counts"]["total"])
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(preparar_db), pool.submit(generar)]
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            sys.exit(1)
+
+    # Paso 3: Insertar datos
+    def insertar():
+        done = checkpoint.state["ingest_tasks"]
+        ingest_dataset.ingest(db, output, args.workers, args.batch_size, resume=bool(done),
+                              done_tasks=set(done), on_task_done=checkpoint.task_done)
+        return sum(db[c].estimated_document_count() for c in ingest_dataset.COLLECTIONS)
+    try:
+        run_step(checkpoint, "ingest", "Insertando datos en MongoDB", insertar)
+        # Paso 4: Inventario por farmacia a partir de las listas embebidas
+        run_step(checkpoint, "inventario", "Generando inventario de farmacias",
+                 lambda: migrate_inventario.migrate(db, rebuild=True)[0])
+        # Paso 5: Índice vectorial de documents (refresh incremental: solo
+        # añade los documentos ingeridos desde el último build)
+        if vector_index is not None and db.documents.find_one({"embeddings.0": {"$exists": True}}, {"_id": 1}):
+            def indice_vectorial():
+                meta, _ = vector_index.refresh(db)
+                return meta["count"] + meta["delta_count"]
+            run_step(checkpoint, "vector_index", "Actualizando índice vectorial", indice_vectorial)
+    except Exception:
+        sys.exit(1)
+
+    counts_reales = {c: db[c].estimated_document_count() for c in ingest_dataset.COLLECTIONS}
     print(f"\n{'='*60}")
     print("🎉 ¡Setup completo exitoso!")
-    print("📊 Tu base de datos está lista con las 7 colecciones:")
-    print("   - Proveedores (20)")
-    print("   - Medicamentos (50)")
-    print("   - Farmacias (10)")
-    print("   - Clientes (40)")
-    print("   - Doctores (25)")
-    print("   - Citas (60)")
-    print("   - Transacciones (80)")
-    print(f"   TOTAL: 285 documentos")
+    print("⏱️  Tiempo por paso:")
+    for step, info in checkpoint.state["steps"].items():
+        rate = f", {info['docs'] / info['seconds']:,.0f} docs/s" if info["docs"] and info["seconds"] else ""
+        print(f"   - {step}: {info['seconds']:.1f}s{rate}")
+    print(f"📊 Tu base de datos está lista con las {len(counts_reales)} colecciones:")
+    for c, n in counts_reales.items():
+        print(f"   - {c.capitalize()} ({n})")
+    print(f"   TOTAL: {sum(counts_reales.values())} documentos")
     print(f"{'='*60}\n")
+
+    # Setup terminado: el siguiente run_all empieza de cero
+    os.remove(STATE_PATH)
+
+
+if __name__ == "__main__":
+    main()
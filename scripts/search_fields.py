@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# scripts/search_fields.py
+# Campo `busqueda` para el autocompletado de /search: el nombre normalizado
+# (minúsculas, sin acentos) y los sufijos que empiezan en cada palabra, así
+# un prefijo como "perez" o "para" se resuelve con un rango sobre el índice
+# de `busqueda`. La ingesta lo calcula al insertar; este script lo rellena
+# en los documentos que ya existían.
+import argparse
+import os
+import unicodedata
+from pymongo import MongoClient, UpdateOne
+from dotenv import load_dotenv
+
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
+
+# Campos que forman el nombre buscable de cada colección
+SEARCH_FIELDS = {
+    "medicamentos": ["nombre"],
+    "clientes": ["nombre"],
+    "doctores": ["nombre", "apellido"],
+}
+
+
+def normaliza(texto):
+    texto = unicodedata.normalize("NFKD", texto)
+    return " ".join("".join(c for c in texto if not unicodedata.combining(c)).lower().split())
+
+
+def search_terms(collection, doc):
+    palabras = normaliza(" ".join(doc.get(f) or "" for f in SEARCH_FIELDS[collection])).split()
+    return [" ".join(palabras[i:]) for i in range(len(palabras))]
+
+
+def add_search_fields(collection, docs):
+    if collection in SEARCH_FIELDS:
+        for doc in docs:
+            doc["busqueda"] = search_terms(collection, doc)
+    return docs
+
+
+def backfill(db, collections=None, batch_size=1000):
+    updated = {}
+    for collection in collections or SEARCH_FIELDS:
+        fields = dict.fromkeys(SEARCH_FIELDS[collection], 1)
+        ops, updated[collection] = [], 0
+        for doc in db[collection].find({}, fields):
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"busqueda": search_terms(collection, doc)}}))
+            if len(ops) >= batch_size:
+                updated[collection] += db[collection].bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            updated[collection] += db[collection].bulk_write(ops, ordered=False).modified_count
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rellena el campo de búsqueda normalizado")
+    parser.add_argument("--collection", action="append", choices=list(SEARCH_FIELDS),
+                        help="Colección a procesar (se puede repetir; por defecto todas)")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    db = MongoClient(MONGO_URI)[DB_NAME]
+    for collection, n in backfill(db, args.collection, args.batch_size).items():
+        print(f"  ✓ {collection}: {n} documentos actualizados")
+
+
+if __name__ == "__main__":
+    main()
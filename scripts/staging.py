@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# scripts/staging.py
+# Recarga de colecciones sin que la API vea datos a medias: se escribe en
+# <colección>__staging, se crean los índices al final de la carga y se
+# intercambia con renameCollection(dropTarget=True), que es atómico.
+from datetime import datetime, timezone
+from pymongo import ReturnDocument
+from create_indexes_and_validators import apply_indexes
+
+STAGING_SUFFIX = "__staging"
+# Contadores de versión por colección (ETag/Last-Modified de la API)
+VERSIONS_COLLECTION = "_versiones"
+
+
+def create_staging(db, collection):
+    staging = collection + STAGING_SUFFIX
+    db.drop_collection(staging)
+    db.create_collection(staging)
+    return staging
+
+
+def drop_staging(db, collection):
+    db.drop_collection(collection + STAGING_SUFFIX)
+
+
+def swap_in(db, collection):
+    # Índices sobre la colección ya cargada (más rápido que mantenerlos
+    # durante la inserción) y reemplazo atómico de la colección viva.
+    staging = collection + STAGING_SUFFIX
+    apply_indexes(db, collection, staging)
+    db[staging].rename(collection, dropTarget=True)
+    bump_version(db, collection)
+
+
+def bump_version(db, collection):
+    return db[VERSIONS_COLLECTION].find_one_and_update(
+        {"_id": collection},
+        {"$inc": {"version": 1}, "$set": {"modificado": datetime.now(timezone.utc).replace(microsecond=0)}},
+        upsert=True, return_document=ReturnDocument.AFTER)["version"]
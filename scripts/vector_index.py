@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# scripts/vector_index.py
+# Índice vectorial local sobre documents.embeddings para /documents/search.
+# Los vectores (float32, normalizados: similitud coseno = producto punto)
+# se guardan como .npy que la API abre con mmap, en dos segmentos:
+# - main: todo el corpus; con --nlist > 0 (o automático a partir de
+#   IVF_MIN_DOCS) se agrupa con k-means en listas IVF contiguas para que una
+#   consulta solo recorra las nprobe listas más cercanas.
+# - delta: documentos ingeridos después del último build (por ingest_ts), que
+#   se buscan por fuerza bruta. Cada refresh incremental solo reescribe el
+#   delta; cuando crece más de DELTA_MAX_RATIO se reconstruye todo.
+# meta.json apunta a los directorios de cada segmento y se reemplaza de forma
+# atómica al final, así la API nunca ve un índice a medio escribir.
+# run_all.py hace un refresh tras la carga; --watch SEG lo repite cada SEG
+# segundos para seguir la ingesta de documentos mientras ocurre.
+import argparse
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+import numpy as np
+from bson import json_util
+from pymongo import MongoClient
+from dotenv import load_dotenv
+
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "rag_pharmacien")
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", os.path.join(SCRIPTS_DIR, "data", "vector_index"))
+IVF_MIN_DOCS = 10000
+DELTA_MAX_RATIO = 0.2
+KMEANS_SAMPLE = 50000
+
+
+def read_meta(index_dir):
+    path = os.path.join(index_dir, "meta.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_meta(index_dir, meta):
+    tmp = os.path.join(index_dir, "meta.json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, os.path.join(index_dir, "meta.json"))
+
+
+def fetch_embeddings(db, since=None, vistos=(), batch_size=10000):
+    # Devuelve (ids, matriz normalizada, último ingest_ts, ids con ese
+    # ingest_ts, descartados). Con $gte: una ingesta por lotes pone el mismo
+    # ingest_ts a muchos documentos y un refresh a mitad de lote no debe
+    # perder los que llegan después; `vistos` son los ya indexados con `since`.
+    query = {"embeddings": {"$type": "array", "$ne": []}}
+    if since is not None:
+        query["ingest_ts"] = {"$gte": since}
+    vistos = set(vistos)
+    ids, rows, ultimo, dim, descartados = [], [], since, None, 0
+    en_ultimo = set(vistos)
+    cursor = db.documents.find(query, {"embeddings": 1, "ingest_ts": 1}).batch_size(batch_size)
+    for doc in cursor:
+        ts = doc.get("ingest_ts")
+        if since is not None and ts == since and str(doc["_id"]) in vistos:
+            continue
+        vector = doc["embeddings"]
+        if dim is None:
+            dim = len(vector)
+        if len(vector) != dim:
+            descartados += 1
+            continue
+        ids.append(doc["_id"])
+        rows.append(vector)
+        if ts is not None and (ultimo is None or ts > ultimo):
+            ultimo, en_ultimo = ts, set()
+        if ts is not None and ts == ultimo:
+            en_ultimo.add(str(doc["_id"]))
+    matrix = np.asarray(rows, dtype=np.float32).reshape(len(rows), dim or 0)
+    return ids, normalize(matrix), ultimo, sorted(en_ultimo), descartados
+
+
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def kmeans(matrix, nlist, iterations=10, seed=0):
+    # Lloyd sobre una muestra; con vectores normalizados el centroide más
+    # cercano es el de mayor producto punto.
+    rng = np.random.default_rng(seed)
+    sample = matrix[rng.choice(len(matrix), min(len(matrix), KMEANS_SAMPLE), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    return centroids
+
+
+def assign_lists(matrix, centroids, chunk=65536):
+    return np.concatenate([np.argmax(matrix[i:i + chunk] @ centroids.T, axis=1)
+                           for i in range(0, len(matrix), chunk)] or [np.empty(0, dtype=np.int64)])
+
+
+def write_segment(index_dir, name, ids, matrix, centroids=None):
+    path = os.path.join(index_dir, name)
+    os.makedirs(path, exist_ok=True)
+    if centroids is not None:
+        # Filas ordenadas por lista: cada lista IVF es un rango contiguo
+        assign = assign_lists(matrix, centroids)
+        order = np.argsort(assign, kind="stable")
+        matrix, ids = matrix[order], [ids[i] for i in order]
+        offsets = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+        np.save(os.path.join(path, "centroids.npy"), centroids.astype(np.float32))
+        np.save(os.path.join(path, "offsets.npy"), offsets.astype(np.int64))
+    np.save(os.path.join(path, "vectors.npy"), np.ascontiguousarray(matrix, dtype=np.float32))
+    with open(os.path.join(path, "ids.json"), "w", encoding="utf-8") as f:
+        f.write(json_util.dumps(ids))
+    return name
+
+
+def read_segment(index_dir, name):
+    path = os.path.join(index_dir, name)
+    with open(os.path.join(path, "ids.json"), "r", encoding="utf-8") as f:
+        ids = json_util.loads(f.read())
+    return ids, np.load(os.path.join(path, "vectors.npy"))
+
+
+def remove_unused(index_dir, meta):
+    # Los segmentos anteriores se conservan un ciclo: la API puede tenerlos
+    # abiertos con mmap hasta que recargue meta.json.
+    keep = {meta["main"], meta.get("delta"), meta.get("previous_main"), meta.get("previous_delta")}
+    for name in os.listdir(index_dir):
+        if (name.startswith("main-") or name.startswith("delta-")) and name not in keep:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+
+def build(db, index_dir=INDEX_DIR, nlist=None):
+    os.makedirs(index_dir, exist_ok=True)
+    previous = read_meta(index_dir) or {}
+    ids, matrix, ultimo, en_ultimo, descartados = fetch_embeddings(db)
+    if nlist is None:
+        nlist = int(np.sqrt(len(ids))) if len(ids) >= IVF_MIN_DOCS else 0
+    nlist = min(nlist, len(ids))
+    centroids = kmeans(matrix, nlist) if nlist else None
+    generation = previous.get("generation", 0) + 1
+    meta = {
+        "generation": generation,
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "dim": int(matrix.shape[1]),
+        "count": len(ids),
+        "nlist": nlist,
+        "main": write_segment(index_dir, f"main-{generation}", ids, matrix, centroids),
+        "delta": None,
+        "delta_count": 0,
+        "ultimo_ingest_ts": json_util.dumps(ultimo) if ultimo is not None else None,
+        "ids_ultimo_ts": en_ultimo,
+        "previous_main": previous.get("main"),
+        "previous_delta": previous.get("delta"),
+    }
+    write_meta(index_dir, meta)
+    remove_unused(index_dir, meta)
+    return meta, descartados
+
+
+def refresh(db, index_dir=INDEX_DIR):
+    # Añade al delta los documentos con ingest_ts posterior al último visto
+    meta = read_meta(index_dir)
+    if meta is None:
+        return build(db, index_dir)
+    since = json_util.loads(meta["ultimo_ingest_ts"]) if meta.get("ultimo_ingest_ts") else None
+    ids, matrix, ultimo, en_ultimo, descartados = fetch_embeddings(db, since, meta.get("ids_ultimo_ts") or ())
+    if not ids:
+        return meta, descartados
+    if not meta["count"]:
+        return build(db, index_dir)
+    if matrix.shape[1] != meta["dim"]:
+        raise ValueError(f"Dimensión {matrix.shape[1]} distinta de la del índice ({meta['dim']}); usa --rebuild")
+    if meta.get("delta"):
+        old_ids, old_matrix = read_segment(index_dir, meta["delta"])
+        # Un documento reingerido reemplaza su versión anterior del delta
+        nuevos = set(map(str, ids))
+        keep = [i for i, id in enumerate(old_ids) if str(id) not in nuevos]
+        ids = [old_ids[i] for i in keep] + ids
+        matrix = np.concatenate([old_matrix[keep], matrix])
+    if len(ids) > DELTA_MAX_RATIO * max(meta["count"], 1):
+        return build(db, index_dir, meta["nlist"] or None)
+
+    generation = meta["generation"] + 1
+    meta.update({
+        "generation": generation,
+        "previous_delta": meta.get("delta"),
+        "delta": write_segment(index_dir, f"delta-{generation}", ids, matrix),
+        "delta_count": len(ids),
+        "ultimo_ingest_ts": json_util.dumps(ultimo),
+        "ids_ultimo_ts": en_ultimo,
+    })
+    write_meta(index_dir, meta)
+    remove_unused(index_dir, meta)
+    return meta, descartados
+
+
+def report(meta, descartados, seconds):
+    print(f"Índice generación {meta['generation']}: {meta['count']} vectores (dim {meta['dim']}, "
+          f"nlist {meta['nlist']}) + {meta['delta_count']} en delta [{seconds:.1f}s]", flush=True)
+    if descartados:
+        print(f"  ⚠️  {descartados} documentos con dimensión distinta descartados")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Índice vectorial de documents.embeddings")
+    parser.add_argument("--rebuild", action="store_true", help="Reconstruir todo (por defecto: refresh incremental)")
+    parser.add_argument("--nlist", type=int, default=None,
+                        help=f"Listas IVF (0 = fuerza bruta; por defecto sqrt(N) a partir de {IVF_MIN_DOCS} docs)")
+    parser.add_argument("--dir", default=INDEX_DIR)
+    parser.add_argument("--watch", type=float, default=None, metavar="SEG",
+                        help="Tras el primer paso, refresh incremental cada SEG segundos (no termina)")
+    args = parser.parse_args()
+
+    db = MongoClient(MONGO_URI)[DB_NAME]
+    t0 = time.perf_counter()
+    if args.rebuild:
+        meta, descartados = build(db, args.dir, args.nlist)
+    else:
+        meta, descartados = refresh(db, args.dir)
+    report(meta, descartados, time.perf_counter() - t0)
+    while args.watch:
+        time.sleep(args.watch)
+        generation = meta["generation"]
+        t0 = time.perf_counter()
+        meta, descartados = refresh(db, args.dir)
+        if meta["generation"] != generation:
+            report(meta, descartados, time.perf_counter() - t0)
+
+
+if __name__ == "__main__":
+    main()